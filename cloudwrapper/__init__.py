@@ -27,6 +27,10 @@ idm -- Influx DB Metric.
 idl -- Influx DB Logging.
 idb -- Influx DB direct use (as SQL database).
 
+- Utilities:
+replica -- Read replicas of one bucket in multiple regions.
+consumer -- Concurrent consumer of queues.
+
 """
 
 __version__ = '2.7'
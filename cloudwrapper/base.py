@@ -2,11 +2,45 @@
 Base classes.
 
 BaseQueue
+BaseMessage
 BaseBucket
+PeriodicThread
+StatsCache
+Backoff
+chunks
 
 Copyright (C) 2016-2020 Klokan Technologies GmbH (http://www.klokantech.com/)
 """
 
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import tempfile
+import threading
+import zlib
+
+from time import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def chunks(iterable, size):
+    """Split any iterable (also a generator) into lists of size items."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
 class BaseQueue(object):
 
@@ -20,12 +54,106 @@ class BaseQueue(object):
     def put_nowait(self, item):
         return self.put(item, False)
 
-    def get_nowait(self):
-        return self.get(False)
+    def get_nowait(self, handle=False):
+        return self.get(False, handle=handle)
+
+
+class BaseMessage(object):
+    """
+    Handle of one message gotten from a queue by get(handle=True).
+
+    Each handle is acknowledged independently of other messages
+    and of the current message of the queue, so one queue object
+    can have many messages in flight.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def ack(self):
+        """Acknowledge that the message is processed."""
+        raise NotImplementedError
+
+    def extend(self, lease_time=None):
+        """Extend the time the message stays leased."""
+        raise NotImplementedError
+
+    def nack(self, delay=0):
+        """Return the message back to the queue."""
+        raise NotImplementedError
 
 
 class BaseBucket(object):
 
+    # Content types of objects worth compressing, by extension
+    COMPRESS_TYPES = {
+        '.pbf': 'application/x-protobuf',
+        '.mvt': 'application/vnd.mapbox-vector-tile',
+        '.json': 'application/json',
+        '.geojson': 'application/geo+json',
+        '.topojson': 'application/json',
+        '.txt': 'text/plain',
+        '.csv': 'text/csv',
+        '.xml': 'application/xml',
+        '.svg': 'image/svg+xml',
+        '.html': 'text/html',
+        '.css': 'text/css',
+        '.js': 'application/javascript',
+    }
+    COMPRESS_CHUNK_SIZE = (1 << 20)  # 1 MB
+
+    def content_type(self, target):
+        ext = os.path.splitext(target)[1].lower()
+        if ext in self.COMPRESS_TYPES:
+            return self.COMPRESS_TYPES[ext]
+        return mimetypes.guess_type(target)[0] or 'application/octet-stream'
+
+    def compressible(self, target):
+        return os.path.splitext(target)[1].lower() in self.COMPRESS_TYPES
+
+    def compress(self, source, encoding, callback=None):
+        """Compress the source file into a temporary file.
+
+        @param encoding - 'gzip' or 'br' (requires brotli package).
+        @param callback - called with every chunk of compressed data.
+
+        Returns path of the temporary file (to be removed by the caller)
+        and MD5 tuple (hex, base64) of the compressed data.
+        """
+        if encoding == 'gzip':
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            process, finish = compressor.compress, compressor.flush
+        elif encoding == 'br':
+            if brotli is None:
+                raise Exception('Brotli compression requires brotli package.')
+            compressor = brotli.Compressor()
+            process, finish = compressor.process, compressor.finish
+        else:
+            raise Exception('Unknown content encoding {}.'.format(encoding))
+
+        md5 = hashlib.md5()
+        fd, path = tempfile.mkstemp(prefix='cloudwrapper-')
+        try:
+            with os.fdopen(fd, 'wb') as target, open(source, 'rb') as fp:
+
+                def write(data):
+                    if data:
+                        target.write(data)
+                        md5.update(data)
+                        if callback is not None:
+                            callback(data)
+
+                chunk = fp.read(self.COMPRESS_CHUNK_SIZE)
+                while chunk:
+                    write(process(chunk))
+                    chunk = fp.read(self.COMPRESS_CHUNK_SIZE)
+                write(finish())
+        except:
+            os.remove(path)
+            raise
+        return path, (md5.hexdigest(),
+                      base64.b64encode(md5.digest()).decode('utf-8'))
+
     def put(self, source, target):
         raise NotImplementedError
 
@@ -35,14 +163,149 @@ class BaseBucket(object):
     def has(self, source):
         raise NotImplementedError
 
+    def exists(self, source):
+        """Like has(), but raise on errors instead of returning False."""
+        return self.has(source)
+
     def list(self, prefix=None):
         raise NotImplementedError
 
     def size(self, source):
         raise NotImplementedError
 
+    def delete(self, source):
+        raise NotImplementedError
+
+    def delete_many(self, sources):
+        """Delete objects, return dict name -> True if deleted."""
+        return dict((source, self.delete(source)) for source in sources)
+
+    def delete_prefix(self, prefix):
+        """Delete all objects with prefix, return per-key results."""
+        return self.delete_many(key.name for key in self.list(prefix))
+
     def is_public(self, source):
         return True
 
     def make_public(self, source):
         pass
+
+
+class PeriodicThread(threading.Thread):
+    """Daemon thread calling function every interval seconds until stopped.
+
+    The last exception raised by the function is kept in exception.
+    """
+
+    def __init__(self, interval, function):
+        super(PeriodicThread, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.function = function
+        self.exception = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.function()
+            except Exception as ex:
+                self.exception = ex
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+
+class StatsCache(object):
+    """
+    Snapshots of queue stats with a freshness window (ttl seconds).
+
+    Snapshots are shared by all instances in the process and optionally
+    by processes on the host through small JSON files in directory.
+    Only one thread of the process loads an outdated snapshot.
+    """
+
+    _snapshots = {}
+    _locks = {}
+    _lock = threading.Lock()
+
+    def __init__(self, ttl=1.0, directory=None):
+        self.ttl = ttl
+        self.directory = directory
+
+    def _path(self, key):
+        name = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return os.path.join(
+            self.directory, 'cloudwrapper-{}.json'.format(name))
+
+    def _fresh(self, snapshot, now):
+        return snapshot is not None and now - snapshot[0] < self.ttl
+
+    def _read(self, key):
+        try:
+            with open(self._path(key)) as fp:
+                data = json.load(fp)
+            return data['timestamp'], data['value']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, key, snapshot):
+        path = self._path(key)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'timestamp': snapshot[0], 'value': snapshot[1]}, fp)
+            # Atomic replace, readers never see a partial file
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def get(self, key, loader):
+        """Return fresh snapshot of key, call loader() if there is none."""
+        with StatsCache._lock:
+            lock = StatsCache._locks.setdefault(key, threading.Lock())
+        with lock:
+            now = time()
+            snapshot = StatsCache._snapshots.get(key)
+            if self._fresh(snapshot, now):
+                return snapshot[1]
+            if self.directory is not None:
+                snapshot = self._read(key)
+                if self._fresh(snapshot, now):
+                    StatsCache._snapshots[key] = snapshot
+                    return snapshot[1]
+            snapshot = (now, loader())
+            StatsCache._snapshots[key] = snapshot
+            if self.directory is not None:
+                self._write(key, snapshot)
+            return snapshot[1]
+
+
+class Backoff(object):
+    """
+    Polling intervals of an empty queue.
+
+    The first poll after work was seen (reset) comes after minimum seconds,
+    every next one waits factor times longer up to maximum.
+    Each interval is shortened by a random part (jitter) so idle workers
+    do not poll at the same moment.
+    """
+
+    def __init__(self, minimum=0.5, maximum=20, factor=2, jitter=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.current = 0
+
+    def reset(self):
+        self.current = 0
+
+    def next(self):
+        if self.current:
+            self.current = min(self.current * self.factor, self.maximum)
+        else:
+            self.current = self.minimum
+        return self.current * (1 - self.jitter * random.random())
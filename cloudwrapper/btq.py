@@ -4,12 +4,17 @@ Copyright (C) 2016-2020 Klokan Technologies GmbH (http://www.klokantech.com/)
 Author: Martin Mikita <martin.mikita@klokantech.com>
 """
 
+import base64
 import json
+import math
 import sys
 import errno
+import threading
+import zlib
 
+from collections import deque
 from time import sleep, time
-from .base import BaseQueue
+from .base import BaseQueue, BaseMessage, PeriodicThread, StatsCache
 
 if sys.version[0] == '2':
     from Queue import Empty
@@ -18,7 +23,8 @@ else:
 
 try:
     import yaml  # noqa
-    from beanstalkc import Connection, SocketError, DEFAULT_PRIORITY
+    from beanstalkc import Connection, CommandFailed, SocketError, \
+        DEFAULT_PRIORITY
 except ImportError:
     from warnings import warn
     install_modules = [
@@ -29,20 +35,219 @@ except ImportError:
         '\n  - '.join(install_modules)))
     raise
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Headers of compressed payloads, JSON never starts with them
+CODEC_HEADERS = {
+    'zlib': 'cw:zlib:',
+    'zstd': 'cw:zstd:',
+}
+
+# Replies followed by a body, its size is the last argument
+BODY_REPLIES = ('RESERVED', 'FOUND', 'OK')
+
+
+def _encode(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+
+def _pipeline(connection, commands, raw=False):
+    """Send all commands at once, then yield their replies in order.
+
+    Replies are tuples (status, arguments, body), with raw the body
+    is returned as read from the socket (including trailing CRLF).
+    This uses beanstalkc internals, as beanstalkc itself waits
+    for a reply after each command.
+    """
+    SocketError.wrap(connection._socket.sendall, b''.join(commands))
+    for _ in commands:
+        status, arguments = connection._read_response()
+        body = None
+        if status in BODY_REPLIES:
+            size = int(arguments[-1])
+            if raw:
+                body = SocketError.wrap(
+                    connection._socket_file.read, size + 2)
+            else:
+                body = connection._read_body(size)
+        yield status, arguments, body
+
 
 class BtqConnection(object):
 
-    def __init__(self, host='localhost', port=11300, max_size=65300):
+    def __init__(self, host='localhost', port=11300, max_size=65300,
+                 compress_threshold=None, codec='zlib'):
         self.host = host
         self.port = int(port)
         self.max_size = max(int(max_size or 0), 65300)
+        self.compress_threshold = compress_threshold
+        self.codec = codec
+        self.pool = ConnectionPool(self.host, self.port)
 
-    def queue(self, name):
-        return Queue(Connection(self.host, self.port), name, self.max_size)
+    def queue(self, name, **options):
+        options.setdefault('compress_threshold', self.compress_threshold)
+        options.setdefault('codec', self.codec)
+        return Queue(self.pool, name, self.max_size, **options)
 
-    def clear(self, name):
+    def clear(self, name, progress=None):
         q = self.queue(name)
-        q.clear()
+        return q.purge(progress=progress)
+
+    def close(self):
+        self.pool.close()
+
+
+class ConnectionPool(object):
+    """
+    Beanstalk connections, one for every thread and tube.
+
+    Each connection uses and watches only its tube. Reconnection restores
+    the tube state, so queues sharing the pool never see it.
+    Commands of other threads on a connection (like touching its jobs)
+    have to hold the lock of the connection.
+
+    Connections of exited threads are closed when another connection
+    is registered, so jobs have to be finished before their thread ends.
+    """
+
+    def __init__(self, host='localhost', port=11300):
+        self.host = host
+        self.port = int(port)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}  # connection -> (lock, thread)
+
+    def _thread_connections(self):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        return connections
+
+    def _register(self, tube, connection):
+        self._thread_connections()[tube] = connection
+        with self._lock:
+            dead = [
+                dead for dead, (_lock, thread) in self._connections.items()
+                if not thread.is_alive()]
+            for dead_connection in dead:
+                del self._connections[dead_connection]
+            self._connections[connection] = (
+                threading.RLock(), threading.current_thread())
+        for dead_connection in dead:
+            try:
+                dead_connection.close()
+            except SocketError:
+                pass
+
+    def lock(self, connection):
+        """Return lock serializing commands on the connection."""
+        return self._connections[connection][0]
+
+    def add(self, tube, connection):
+        """Use an existing connection for the tube in the current thread."""
+        self._register(tube, connection)
+        try:
+            self._setup(tube, connection)
+        except SocketError:
+            self.reconnect(tube)
+
+    def get(self, tube, attempts=6, timeout=2):
+        """Return connection of the current thread for the tube."""
+        connection = self._thread_connections().get(tube)
+        if connection is None:
+            for _repeat in range(attempts):
+                try:
+                    connection = Connection(self.host, self.port)
+                    break
+                except SocketError:
+                    sleep(_repeat * timeout + 1)
+            else:
+                raise Exception('Cannot connect to the beanstalk server.')
+            self._register(tube, connection)
+            self._setup(tube, connection)
+        return connection
+
+    def _setup(self, tube, connection):
+        connection.use(tube)
+        connection.watch(tube)
+        # Ignore others tubes
+        for watched in connection.watching():
+            if not tube == watched:
+                connection.ignore(watched)
+
+    def reconnect(self, tube, attempts=6, timeout=2):
+        """Reconnect connection of the current thread for the tube."""
+        connection = self.get(tube, attempts, timeout)
+        for _repeat in range(attempts):
+            try:
+                connection.reconnect()
+                self._setup(tube, connection)
+                break
+            except SocketError:
+                sleep(_repeat * timeout + 1)
+        else:
+            raise Exception('Cannot reconnect to the beanstalk server.')
+
+    def close(self):
+        """Close connections of all threads."""
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for connection in connections:
+            try:
+                connection.close()
+            except SocketError:
+                pass
+        self._local = threading.local()
+
+
+class Job(BaseMessage):
+    """
+    Handle of one reserved job.
+
+    Only the connection which reserved the job can acknowledge it,
+    the commands are serialized by the lock of the connection.
+    """
+
+    def __init__(self, queue, connection, jid, body, deadline=None,
+                 priority=DEFAULT_PRIORITY, ttr=None):
+        super(Job, self).__init__(body)
+        self.queue = queue
+        self.connection = connection
+        self.lock = queue.pool.lock(connection)
+        self.jid = jid
+        self.deadline = deadline
+        self.priority = priority
+        self.ttr = ttr
+        self.touched = time()
+
+    def ack(self):
+        self.queue._untrack(self)
+        with self.lock:
+            self.connection.delete(self.jid)
+
+    def touch(self):
+        with self.lock:
+            self.connection.touch(self.jid)
+        self.touched = time()
+
+    def release(self, delay=0, priority=None):
+        if priority is None:
+            priority = self.priority
+        self.queue._untrack(self)
+        with self.lock:
+            self.connection.release(self.jid, priority, delay)
+
+    def extend(self, lease_time=None):
+        self.touch()
+
+    def nack(self, delay=0):
+        self.release(delay)
 
 
 class Queue(BaseQueue):
@@ -53,40 +258,155 @@ class Queue(BaseQueue):
     calling task_done(). Otherwise they will appear back in the
     queue, after a period of time called 'visibility time'. This
     parameter, and others, are configured outside this module.
+
+    The queue can be shared between threads, every thread uses its own
+    connection from the ConnectionPool and has its own current message.
+
+    With prefetch > 0, every thread reserves up to prefetch jobs at once
+    (pipelined reserve-with-timeout 0) and get() serves them locally.
+    Prefetched jobs are released back prefetch_margin seconds before
+    their TTR expires; close() releases the rest.
+
+    With keepalive (a fraction of TTR, e.g. 0.5), a background thread
+    touches every gotten job not yet acknowledged or released, whenever
+    that fraction of its TTR (learned from stats-job) passes.
+
+    Acknowledging, touching and releasing a job has to go through the
+    connection which reserved it, so blocking reserves wait in one second
+    slices to let commands of other threads in.
+
+    With compress_threshold, payloads with JSON larger than that (bytes)
+    are compressed by codec ('zlib' or 'zstd' with zstandard package),
+    base64 encoded and marked by a header. The result has to fit into
+    max_size. deserialize_task() decompresses them, uncompressed
+    payloads are decoded as before.
+
+    qsize() and has_available() read tube stats from a snapshot not older
+    than stats_ttl seconds, shared within the process and, with
+    stats_cache_dir, by all processes on the host.
     """
 
-    def __init__(self, handle, name, max_size):
-        self.handle = handle
+    KICK_BOUND = 100000  # Jobs kicked by one command of purge()
+
+    def __init__(self, handle, name, max_size, prefetch=0, prefetch_margin=5,
+                 keepalive=None, compress_threshold=None, codec='zlib',
+                 stats_ttl=1.0, stats_cache_dir=None):
+        self._local = threading.local()
+        if isinstance(handle, ConnectionPool):
+            self.pool = handle
+        else:
+            # Backward compatible single beanstalkc.Connection
+            self.pool = ConnectionPool(handle.host, handle.port)
+            self.pool.add(name, handle)
         self.name = name
         self.max_size = max_size
+        if codec not in CODEC_HEADERS:
+            raise Exception('Unknown codec {}.'.format(codec))
+        if codec == 'zstd' and zstandard is None:
+            raise Exception('Codec zstd requires zstandard package.')
+        self.compress_threshold = compress_threshold
+        self.codec = codec
+        self.stats_cache = StatsCache(stats_ttl, stats_cache_dir)
+        self.prefetch = int(prefetch or 0)
+        self.prefetch_margin = prefetch_margin
         self.message = None
-        self.available_timestamp = None
 
         self.reconnectAttempts = 6
         self.reconnectTimeout = 2
 
-        self._reconnect()
+        # Connect the current thread
+        self.pool.get(self.name, self.reconnectAttempts, self.reconnectTimeout)
+
+        self.keepalive = keepalive
+        self.in_flight = {}
+        self._keepalive_lock = threading.Lock()
+        self._keepalive_thread = None
+        if keepalive:
+            self._keepalive_thread = PeriodicThread(1, self._touch_in_flight)
+            self._keepalive_thread.start()
+
+    @property
+    def handle(self):
+        return self.pool.get(
+            self.name, self.reconnectAttempts, self.reconnectTimeout)
+
+    @property
+    def message(self):
+        return getattr(self._local, 'message', None)
+
+    @message.setter
+    def message(self, message):
+        self._local.message = message
+
+    @property
+    def buffer(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = deque()
+        return buffer
 
     def _reconnect(self):
-        for _repeat in range(self.reconnectAttempts):
+        self.pool.reconnect(
+            self.name, self.reconnectAttempts, self.reconnectTimeout)
+
+    def _track(self, job):
+        if self._keepalive_thread is not None:
+            with self._keepalive_lock:
+                self.in_flight[job.jid] = job
+
+    def _untrack(self, job):
+        with self._keepalive_lock:
+            self.in_flight.pop(job.jid, None)
+
+    def _touch_in_flight(self):
+        """Touch in-flight jobs (runs in the keep-alive thread)."""
+        with self._keepalive_lock:
+            jobs = list(self.in_flight.values())
+        unknown = [job for job in jobs if job.ttr is None]
+        error = None
+        if unknown:
             try:
-                self.handle.reconnect()
-                self.handle.use(self.name)
-                self.handle.watch(self.name)
-                break
-            except SocketError:
-                sleep(_repeat * self.reconnectTimeout + 1)
-        else:
-            raise Exception('Cannot reconnect to the beanstalk server.')
-        # Ignore others tubes
-        for tube in self.handle.watching():
-            if not self.name == tube:
-                self.handle.ignore(tube)
+                self._load_ttr(unknown)
+            except (IOError, SocketError):
+                # Jobs with known TTR are touched anyway
+                try:
+                    self._reconnect()
+                except Exception as ex:
+                    error = ex
+        now = time()
+        for job in jobs:
+            if job.ttr is None or now < job.touched + self.keepalive * job.ttr:
+                continue
+            try:
+                job.touch()
+            except (CommandFailed, SocketError):
+                # Job is not reserved by its connection anymore
+                self._untrack(job)
+        if error is not None:
+            raise error
+
+    def _load_ttr(self, jobs):
+        """Set TTR of jobs by stats-job (runs in the keep-alive thread)."""
+        # Dedicated connection of this thread, stats work from any
+        connection = self.handle
+        replies = _pipeline(
+            connection,
+            [_encode('stats-job %d\r\n' % job.jid) for job in jobs])
+        now = time()
+        for job, (status, _arguments, body) in zip(jobs, replies):
+            if status != 'OK':
+                self._untrack(job)
+                continue
+            info = connection._parse_yaml(body)
+            job.ttr = int(info['ttr'])
+            job.touched = now - (job.ttr - int(info['time-left']))
 
     def _wrap_handle(self, method, *args, **kwargs):
         for _repeat in range(self.reconnectAttempts):
             try:
-                return getattr(self.handle, method)(*args, **kwargs)
+                handle = self.handle
+                with self.pool.lock(handle):
+                    return getattr(handle, method)(*args, **kwargs)
             except IOError as e:
                 if e.errno == errno.EPIPE:
                     sleep(_repeat * self.reconnectTimeout + 1)
@@ -103,8 +423,32 @@ class Queue(BaseQueue):
         except:
             return False
 
+    def _compress(self, task_s):
+        data = task_s.encode('utf-8')
+        if self.codec == 'zstd':
+            data = zstandard.ZstdCompressor().compress(data)
+        else:
+            data = zlib.compress(data, 9)
+        return CODEC_HEADERS[self.codec] + \
+            base64.b64encode(data).decode('ascii')
+
+    def _decompress(self, task):
+        for codec, header in CODEC_HEADERS.items():
+            if not task.startswith(header):
+                continue
+            data = base64.b64decode(task[len(header):])
+            if codec == 'zstd':
+                data = zstandard.ZstdDecompressor().decompress(data)
+            else:
+                data = zlib.decompress(data)
+            return data.decode('utf-8')
+        return task
+
     def serialize_task(self, task):
         task_s = json.dumps(task, separators=(',', ':'))
+        if (self.compress_threshold is not None and
+                len(task_s) > self.compress_threshold):
+            task_s = self._compress(task_s)
         if len(task_s) > self.max_size:
             raise Exception('This task is larger than allowed size {}.'.format(
                 self.max_size))
@@ -112,7 +456,7 @@ class Queue(BaseQueue):
 
     def deserialize_task(self, task):
         try:
-            task_o = json.loads(task)
+            task_o = json.loads(self._decompress(task))
             return task_o
         except:
             return task
@@ -122,9 +466,35 @@ class Queue(BaseQueue):
         self.reconnectAttempts = attempts
         self.reconnectTimeout = timeout
 
+    def _load_stats(self):
+        exc = None
+        for _repeat in range(self.reconnectAttempts):
+            try:
+                handle = self.handle
+                with self.pool.lock(handle):
+                    return handle.stats_tube(self.name)
+            except IOError as e:
+                exc = e
+                sleep(_repeat * self.reconnectTimeout + 1)
+                if e.errno == errno.EPIPE:
+                    self._reconnect()
+            except SocketError as e:
+                exc = e
+                sleep(_repeat * self.reconnectTimeout + 1)
+                self._reconnect()
+        if exc is not None:
+            raise exc
+        return {}
+
+    def stats(self):
+        """Return snapshot of the tube stats."""
+        return self.stats_cache.get(
+            'btq:{}:{}:{}'.format(self.pool.host, self.pool.port, self.name),
+            self._load_stats)
+
     def qsize(self):
         # Get size of ready and reserved jobs in current tube
-        stats = self._wrap_handle('stats_tube', self.name)
+        stats = self.stats()
         num = 0
         if 'current-jobs-ready' in stats:
             num += stats['current-jobs-ready']
@@ -151,18 +521,181 @@ class Queue(BaseQueue):
             'put', self.serialize_task(item),
             ttr=ttr, delay=delay, priority=priority)
 
-    def get(self, block=True, timeout=None):
-        """Get an item from the queue."""
+    def put_many(self, items, delay=0, ttr=3600, priority=DEFAULT_PRIORITY,
+                 window=1000):
+        """Put many items into the queue using pipelined put commands.
+
+        Up to window commands are sent without waiting for replies,
+        then all replies are read in order.
+
+        Returns list with job id or exception for every item.
+        On a connection error, items without reply get the SocketError,
+        as they may or may not be inserted.
+        """
+        results = []
+        commands = []
+        for item in items:
+            try:
+                body = _encode(self.serialize_task(item))
+            except Exception as ex:
+                # Serialization errors keep their position in results
+                commands.append(ex)
+            else:
+                commands.append(
+                    _encode('put %d %d %d %d\r\n' % (
+                        priority, delay, ttr, len(body))) + body + b'\r\n')
+            if len(commands) >= window:
+                results.extend(self._put_pipeline(commands))
+                commands = []
+        if commands:
+            results.extend(self._put_pipeline(commands))
+        return results
+
+    def _put_pipeline(self, commands):
+        results = [c if isinstance(c, Exception) else None for c in commands]
+        positions = [i for i, c in enumerate(commands) if results[i] is None]
+        if not positions:
+            return results
+        connection = self.handle
+        done = 0
+        try:
+            with self.pool.lock(connection):
+                for status, arguments, _body in _pipeline(
+                        connection, [commands[i] for i in positions]):
+                    if status == 'INSERTED':
+                        results[positions[done]] = int(arguments[0])
+                    else:
+                        results[positions[done]] = Exception(
+                            'Job not inserted: {} {}'.format(
+                                status, ' '.join(arguments)))
+                    done += 1
+        except SocketError as ex:
+            for i in positions[done:]:
+                results[i] = ex
+            self._reconnect()
+        return results
+
+    def _job(self, message):
+        if message is None:
+            return None
+        return Job(self, message.conn, message.jid,
+                   self.deserialize_task(message.body))
+
+    def _reserve(self, timeout):
+        # Short slices let other threads use the connection for its jobs
+        end = None if timeout is None else time() + timeout
+        while True:
+            wait = 1
+            if end is not None:
+                wait = int(math.ceil(max(0, min(1, end - time()))))
+            message = self._wrap_handle('reserve', timeout=wait)
+            if message is not None or (end is not None and time() >= end):
+                return self._job(message)
+
+    def _release_jobs(self, jobs):
+        connection = self.handle
+        commands = [
+            _encode('release %d %d 0\r\n' % (job.jid, job.priority))
+            for job in jobs if job.connection is connection]
+        if not commands:
+            return
+        try:
+            with self.pool.lock(connection):
+                for _reply in _pipeline(connection, commands):
+                    pass
+        except SocketError:
+            # Jobs are released by the server with the closed connection
+            self._reconnect()
+
+    def _fill_buffer(self):
+        """Reserve up to prefetch jobs with pipelined commands."""
+        connection = self.handle
+        try:
+            with self.pool.lock(connection):
+                reserved = [
+                    (int(arguments[0]), body)
+                    for status, arguments, body in _pipeline(
+                        connection,
+                        [b'reserve-with-timeout 0\r\n'] * self.prefetch)
+                    if status == 'RESERVED']
+                if not reserved:
+                    return
+                # TTR of each job is known from its stats only
+                stats = [
+                    connection._parse_yaml(body) if status == 'OK' else {}
+                    for status, _arguments, body in _pipeline(
+                        connection,
+                        [_encode('stats-job %d\r\n' % jid)
+                         for jid, _body in reserved])]
+        except SocketError:
+            # Reservations are lost with the connection
+            self._reconnect()
+            return
+        now = time()
+        for (jid, body), info in zip(reserved, stats):
+            ttr = int(info.get('ttr', 0)) or None
+            time_left = int(info.get('time-left', 0))
+            job = Job(
+                self, connection, jid, self.deserialize_task(body),
+                deadline=now + time_left,
+                priority=int(info.get('pri', DEFAULT_PRIORITY)), ttr=ttr)
+            if ttr is not None:
+                job.touched = now - (ttr - time_left)
+            self.buffer.append(job)
+
+    def _get_prefetched(self, timeout):
+        buffer = self.buffer
+        deadline = time() + self.prefetch_margin
+        expiring = [job for job in buffer if job.deadline <= deadline]
+        if expiring:
+            for job in expiring:
+                buffer.remove(job)
+            self._release_jobs(expiring)
+        if not buffer:
+            self._fill_buffer()
+        if buffer:
+            return buffer.popleft()
+        if timeout == 0:
+            return None
+        return self._reserve(timeout)
+
+    def get(self, block=True, timeout=None, handle=False):
+        """Get an item from the queue.
+
+        With handle, return Job handle of the item instead, which is
+        acknowledged by its own ack(), extend() or nack().
+        Non-blocking get without timeout does not wait at all.
+        """
         self.message = None
-        if not (
-                (block and timeout is None) or
-                (not block and timeout is not None)):
+        if block and timeout is not None:
             raise Exception('BtqConnection::Queue::get() - invalid arguments.')
+        if not block and timeout is None:
+            timeout = 0
 
-        self.message = self._wrap_handle('reserve', timeout=timeout)
-        if self.message is None:
+        if self.prefetch:
+            job = self._get_prefetched(timeout)
+        else:
+            job = self._reserve(timeout)
+        if job is None:
             raise Empty
-        return self.deserialize_task(self.message.body)
+        self._track(job)
+        if handle:
+            return job
+        self.message = job
+        return job.body
+
+    def close(self):
+        """Release jobs prefetched by the current thread.
+
+        Stop the keep-alive thread as well.
+        """
+        if self._keepalive_thread is not None:
+            self._keepalive_thread.stop()
+            self._keepalive_thread = None
+        jobs = list(self.buffer)
+        self.buffer.clear()
+        if jobs:
+            self._release_jobs(jobs)
 
     def task_done(self):
         """Acknowledge that a formerly enqueued task is complete.
@@ -173,6 +706,7 @@ class Queue(BaseQueue):
         if self.message is None:
             raise Exception('BtqConnection::Queue::task_done() '
                             '- no message to acknowledge.')
+        self._untrack(self.message)
         self._wrap_handle('delete', self.message.jid)
         self.message = None
 
@@ -192,6 +726,7 @@ class Queue(BaseQueue):
         if self.message is None:
             raise Exception('BtqConnection::Queue::task_done() '
                             '- no message to acknowledge.')
+        self._untrack(self.message)
         self._wrap_handle('release', self.message.jid, priority, delay)
         self.message = None
 
@@ -199,48 +734,68 @@ class Queue(BaseQueue):
         """
         It is any message available for lease.
 
-        If there is no message, this state is cached internally for 5 minutes.
-        10 minutes is time used for Google Autoscaler.
+        Read from the tube stats snapshot, see stats_ttl.
         """
-        now = time()
-        # We have cached False response
-        if (self.available_timestamp is not None and
-           now < self.available_timestamp):
-            return False
-
-        # Get oldestTask from queue stats
-        exc = None
-        for _repeat in range(self.reconnectAttempts):
-            try:
-                stats = self.handle.stats_tube(self.name)
-                break
-            except IOError as e:
-                exc = e
-                sleep(_repeat * self.reconnectTimeout + 1)
-                if e.errno == errno.EPIPE:
-                    self._reconnect()
-            except SocketError as e:
-                exc = e
-                sleep(_repeat * self.reconnectTimeout + 1)
-                self._reconnect()
-        else:
-            if exc is not None:
-                raise exc
-            return False
+        stats = self.stats()
         # There is at least one availabe task
         ready = 0
         if 'current-jobs-ready' in stats:
             ready = int(stats['current-jobs-ready'])
-        if ready > 0:
-            return True
-        # No available task, cache this response for 5 minutes
-        self.available_timestamp = now + 300  # 5 minutes
-        return False
+        return ready > 0
 
     def clear(self):
-        while True:
-            try:
-                self.get(block=False, timeout=0)
-            except Empty:
-                break
-            self.task_done()
+        self.purge()
+
+    def purge(self, window=1000, progress=None):
+        """Delete all ready, delayed and buried jobs in the tube.
+
+        Ready jobs are reserved and deleted in windows of pipelined
+        commands. Buried and delayed jobs are kicked back to ready
+        in counts of KICK_BOUND and deleted the same way. A final sweep
+        by peek-* deletes the jobs which appeared meanwhile.
+        Payloads are never deserialized. Jobs reserved by others stay.
+
+        @param progress - called with the number of deleted jobs so far.
+        Returns the number of deleted jobs.
+        """
+        connection = self.handle
+        deleted = 0
+        with self.pool.lock(connection):
+            while True:
+                jids = [
+                    int(arguments[0])
+                    for status, arguments, _body in _pipeline(
+                        connection,
+                        [b'reserve-with-timeout 0\r\n'] * window, raw=True)
+                    if status == 'RESERVED']
+                if jids:
+                    deleted += self._delete_pipeline(connection, jids)
+                    if progress is not None:
+                        progress(deleted)
+                    continue
+                # Kicks buried jobs first, delayed ones when none is buried
+                if not connection.kick(self.KICK_BOUND):
+                    break
+
+            for state in ('ready', 'delayed', 'buried'):
+                peek = _encode('peek-%s\r\n' % state)
+                commands = [peek]
+                while True:
+                    replies = list(_pipeline(connection, commands, raw=True))
+                    deleted += sum(
+                        1 for status, _arguments, _body in replies
+                        if status == 'DELETED')
+                    status, arguments, _body = replies[-1]
+                    if status != 'FOUND':
+                        break
+                    commands = [
+                        _encode('delete %d\r\n' % int(arguments[0])), peek]
+        if progress is not None:
+            progress(deleted)
+        return deleted
+
+    def _delete_pipeline(self, connection, jids):
+        return sum(
+            1 for status, _arguments, _body in _pipeline(
+                connection, [_encode('delete %d\r\n' % jid) for jid in jids])
+            if status == 'DELETED')
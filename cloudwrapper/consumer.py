@@ -0,0 +1,277 @@
+"""Concurrent consumer of queues.
+
+Consumer
+
+Copyright (C) 2016-2020 Klokan Technologies GmbH (http://www.klokantech.com/)
+"""
+
+import signal
+import sys
+import threading
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from time import time
+
+if sys.version[0] == '2':
+    from Queue import Empty, Queue
+else:
+    from queue import Empty, Queue
+
+from .base import Backoff
+
+
+def _call(handler, body):
+    """Run handler in a worker, return (exception, duration)."""
+    start = time()
+    try:
+        handler(body)
+    except Exception as ex:
+        return ex, time() - start
+    return None, time() - start
+
+
+class Consumer(object):
+    """
+    Process messages of any queue (btq, sqs, gtq, gps) concurrently.
+
+    The queue is used only by one dispatcher thread, which gets message
+    handles (get_nowait(handle=True)), acknowledges them and extends their
+    leases. handler(body) runs in a pool of workers threads, or processes
+    with processes=True (the handler must be picklable then).
+
+    At most workers + prefetch messages are in flight. Their leases are
+    extended to lease_time every third of it, so the first extension must
+    come before the lease given by the queue expires (SQS visibility
+    timeout, beanstalk TTR, PubSub ack deadline). A message is acknowledged
+    when the handler returns and returned to the queue after retry_delay
+    seconds when it raises (the last exception is kept in exception).
+    An empty queue is polled with exponential backoff up to poll_interval.
+
+    Messages processed longer than max_processing seconds (e.g. of a dead
+    worker process) are not extended anymore and the queue delivers them
+    again when their lease expires.
+
+    SIGTERM (or stop()) stops getting new messages and waits for messages
+    in flight up to drain_timeout seconds. Then messages whose handlers
+    did not start are returned back to the queue. Handlers still running
+    in threads are left running (the threads are daemons, they are not
+    joined) and their messages are neither acknowledged nor returned,
+    so they are not processed twice at once - the queue delivers them
+    again when their lease expires. Worker processes are terminated,
+    so all their unfinished messages are returned. The queue is closed
+    at the end, so that it sends buffered acknowledgements and releases
+    prefetched messages.
+    """
+
+    LATENCY_SAMPLES = 1000
+
+    def __init__(self, queue, handler, workers=4, processes=False,
+                 prefetch=None, lease_time=60, retry_delay=60,
+                 poll_interval=5, drain_timeout=30, max_processing=3600):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.processes = processes
+        self.prefetch = workers if prefetch is None else prefetch
+        self.lease_time = lease_time
+        self.retry_delay = retry_delay
+        self.polling = Backoff(0.1, poll_interval)
+        self.drain_timeout = drain_timeout
+        self.max_processing = max_processing
+        self.in_flight = {}  # id -> [message, extended, submitted]
+        self.exception = None
+        self._done = Queue()
+        self._stopped = threading.Event()
+        self._state_lock = threading.Lock()
+        self._started = set()
+        self._abandoned = False
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self._processed = 0
+        self._failed = 0
+        self._latency_max = 0
+        self._latency_sum = 0
+
+    def stop(self):
+        """Stop getting messages and drain the messages in flight."""
+        self._stopped.set()
+
+    def stats(self):
+        """Return dict with counts and handler latencies [s]."""
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            count = self._processed + self._failed
+            stats = {
+                'processed': self._processed,
+                'failed': self._failed,
+                'in_flight': len(self.in_flight),
+                'latency_mean': self._latency_sum / count if count else None,
+                'latency_max': self._latency_max if count else None,
+            }
+        for name, quantile in (('latency_p50', 0.5), ('latency_p95', 0.95)):
+            stats[name] = None
+            if latencies:
+                stats[name] = latencies[
+                    min(int(len(latencies) * quantile), len(latencies) - 1)]
+        return stats
+
+    def _record(self, exception, duration):
+        with self._stats_lock:
+            if exception is None:
+                self._processed += 1
+            else:
+                self._failed += 1
+            self._latencies.append(duration)
+            self._latency_sum += duration
+            self._latency_max = max(self._latency_max, duration)
+
+    def _finish(self, key, exception, duration):
+        """Acknowledge or return the message, called by dispatcher."""
+        with self._state_lock:
+            self._started.discard(key)
+        entry = self.in_flight.pop(key, None)
+        if entry is None:
+            # Already given up by draining or after max_processing
+            return
+        self._record(exception, duration)
+        try:
+            if exception is None:
+                entry[0].ack()
+            else:
+                self.exception = exception
+                entry[0].nack(self.retry_delay)
+        except Exception as ex:
+            self.exception = ex
+
+    def _extend(self):
+        now = time()
+        deadline = now - self.lease_time / 3.0
+        for key, entry in list(self.in_flight.items()):
+            if entry[2] + self.max_processing <= now:
+                # Possibly a dead worker, let the lease expire
+                del self.in_flight[key]
+                self.exception = Exception(
+                    'Message not processed in {} seconds.'.format(
+                        self.max_processing))
+                self._record(self.exception, now - entry[2])
+                continue
+            if entry[1] > deadline:
+                continue
+            try:
+                entry[0].extend(self.lease_time)
+            except Exception as ex:
+                self.exception = ex
+            entry[1] = time()
+
+    def _wait(self, timeout):
+        """Wait up to timeout for finished messages, process all of them."""
+        try:
+            done = [self._done.get(True, timeout)]
+        except Empty:
+            return
+        while True:
+            try:
+                done.append(self._done.get(False))
+            except Empty:
+                break
+        for key, (exception, duration) in done:
+            self._finish(key, exception, duration)
+
+    def _run(self, key, body):
+        """Run handler in a worker thread, unless draining is over."""
+        with self._state_lock:
+            if self._abandoned:
+                return None, 0
+            self._started.add(key)
+        return _call(self.handler, body)
+
+    def _submit(self, pool, key, message):
+        def callback(result):
+            self._done.put((key, result))
+
+        def error_callback(exception):
+            # E.g. the body or the result cannot be pickled
+            self._done.put((key, (exception, 0)))
+
+        now = time()
+        self.in_flight[key] = [message, now, now]
+        if self.processes:
+            function, args = _call, (self.handler, message.body)
+        else:
+            function, args = self._run, (key, message.body)
+        options = {'callback': callback}
+        if sys.version[0] != '2':
+            options['error_callback'] = error_callback
+        pool.apply_async(function, args, **options)
+
+    def run(self):
+        """Consume the queue until stop() or SIGTERM, then drain."""
+        try:
+            previous = signal.signal(
+                signal.SIGTERM, lambda signum, frame: self.stop())
+        except ValueError:
+            # Signals can be handled only in the main thread
+            previous = None
+        if self.processes:
+            pool = Pool(self.workers)
+        else:
+            pool = ThreadPool(self.workers)
+        key = 0
+        try:
+            while not self._stopped.is_set():
+                self._extend()
+                if len(self.in_flight) >= self.workers + self.prefetch:
+                    self._wait(1)
+                    continue
+                try:
+                    message = self.queue.get_nowait(handle=True)
+                except Empty:
+                    self._wait(self.polling.next())
+                    continue
+                except Exception as ex:
+                    self.exception = ex
+                    self._wait(self.polling.next())
+                    continue
+                self.polling.reset()
+                key += 1
+                self._submit(pool, key, message)
+                self._wait(0)
+            self._drain(pool)
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGTERM, previous)
+            if self.processes or not self.in_flight:
+                pool.terminate()
+                pool.join()
+            else:
+                # Running handler threads are not waited for
+                pool.close()
+            close = getattr(self.queue, 'close', None)
+            if close is not None:
+                close()
+
+    def _drain(self, pool):
+        deadline = time() + self.drain_timeout
+        while self.in_flight and time() < deadline:
+            self._extend()
+            self._wait(min(1, max(deadline - time(), 0)))
+        if not self.in_flight:
+            return
+        if self.processes:
+            # No handler runs after the workers are terminated
+            pool.terminate()
+            running = set()
+        else:
+            with self._state_lock:
+                self._abandoned = True
+                running = set(self._started)
+        for key in list(self.in_flight):
+            if key in running:
+                # Left to the lease expiration, see the class docstring
+                continue
+            message = self.in_flight.pop(key)[0]
+            try:
+                message.nack()
+            except Exception as ex:
+                self.exception = ex
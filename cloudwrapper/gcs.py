@@ -4,23 +4,30 @@ Copyright (C) 2016-2020 Klokan Technologies GmbH (http://www.klokantech.com/)
 Author: Martin Mikita <martin.mikita@klokantech.com>
 """
 
+import binascii
+import datetime
 import errno
+import hashlib
 import os
 import struct
+import threading
 
+from multiprocessing.pool import ThreadPool
 from time import sleep
 
-from .base import BaseBucket
+from .base import BaseBucket, chunks
 
 try:
     import base64
     import crc32c
     from gcloud import storage, exceptions
+    from oauth2client.service_account import ServiceAccountCredentials
 except ImportError:
     from warnings import warn
     install_modules = [
         'gcloud==0.18.3',
         'crc32c==2.1',
+        'oauth2client==4.1.3',
     ]
     warn('cloudwrapper.gcs requires these packages:\n  - {}'.format(
         '\n  - '.join(install_modules)))
@@ -33,6 +40,15 @@ except ImportError:
     # python3
     from http.client import BadStatusLine, ResponseNotReady
 
+try:
+    # python2
+    from urllib import quote
+    from urllib2 import Request, urlopen
+except ImportError:
+    # python3
+    from urllib.parse import quote
+    from urllib.request import Request, urlopen
+
 
 class DifferentHashException(Exception):
         pass
@@ -57,13 +73,31 @@ class Crc32cCalculator:
 
 class GcsConnection(object):
 
-    def __init__(self):
-        self.connection = storage.Client()
+    SCOPES = ['https://www.googleapis.com/auth/devstorage.full_control']
+
+    def __init__(self, key_file=None):
+        """Connect with default credentials or a service account key file.
 
-    def bucket(self, name, create=False):
+        Credentials from the key_file are also used for signed URLs.
+        """
+        self.credentials = None
+        if key_file is not None:
+            self.credentials = \
+                ServiceAccountCredentials.from_json_keyfile_name(
+                    key_file, scopes=self.SCOPES)
+        self.connection = storage.Client(credentials=self.credentials)
+
+    def bucket(self, name, create=False, public=False):
+        """Return Bucket object.
+
+        @param public - the bucket is known to be publicly readable,
+                        public URLs are generated without any request.
+        """
         for _repeat in range(6):
             try:
-                return Bucket(self.connection.get_bucket(name))
+                return Bucket(
+                    self.connection.get_bucket(name),
+                    credentials=self.credentials, public=public)
             except (exceptions.NotFound) as e:
                 if create:
                     self.connection.create_bucket(name)
@@ -72,7 +106,8 @@ class GcsConnection(object):
             except (IOError, BadStatusLine, ResponseNotReady) as e:
                 sleep(_repeat * 2 + 1)
                 if e.errno == errno.EPIPE:
-                    self.connection = storage.Client()
+                    self.connection = storage.Client(
+                        credentials=self.credentials)
 
     def list(self):
         for _repeat in range(6):
@@ -84,45 +119,211 @@ class GcsConnection(object):
             except (IOError, BadStatusLine, exceptions.GCloudError) as e:
                 sleep(_repeat * 2 + 1)
                 if e.errno == errno.EPIPE:
-                    self.connection = storage.Client()
+                    self.connection = storage.Client(
+                        credentials=self.credentials)
         return buckets
 
 
 class Bucket(BaseBucket):
 
     CHUNK_SIZE = (500 << 20)  # 500 MB
-
-    def __init__(self, handle):
+    DOWNLOAD_CHUNK_SIZE = (1 << 20)  # 1 MB
+    BATCH_SIZE = 100  # GCS limit of calls in one batch request
+    URL_HOST = 'storage.googleapis.com'
+    URL_MAX_EXPIRATION = 604800  # 7 days, V4 signature limit
+
+    def __init__(self, handle, credentials=None, public=False, retries=6):
+        """
+        @param retries - attempts of get, exists, has, size and is_public.
+        """
         self.handle = handle
         self.name = handle.name
+        self.credentials = credentials
+        self.public = public
+        self.retries = retries
+        self._local = threading.local()
 
     def _reconnect(self, name):
-        connection = storage.Client()
+        connection = storage.Client(credentials=self.credentials)
         self.handle = connection.get_bucket(name)
 
+    def _backoff(self, repeat):
+        """Sleep and reconnect if another attempt follows."""
+        if repeat + 1 >= self.retries:
+            return False
+        sleep(repeat * 2 + 1)
+        self._reconnect(self.name)
+        return True
+
+    def _thread_handle(self, reconnect=False):
+        """Bucket handle owned by the current thread.
+
+        The underlying HTTP connection is not thread-safe, so every worker
+        thread gets its own client. Creating the handle is offline.
+        """
+        handle = getattr(self._local, 'handle', None)
+        if handle is None or reconnect:
+            handle = storage.Client(
+                credentials=self.credentials).bucket(self.name)
+            self._local.handle = handle
+        return handle
+
+    def _copy(self, names):
+        """Server-side copy of (source, target) pairs, return failed ones."""
+        failed = []
+        for source, target in names:
+            for _repeat in range(6):
+                try:
+                    handle = self._thread_handle(reconnect=_repeat > 0)
+                    handle.copy_blob(handle.blob(source), handle, target)
+                    break
+                except exceptions.NotFound:
+                    # Source is gone, verification decides about it
+                    break
+                except (IOError, BadStatusLine, ResponseNotReady,
+                        exceptions.GCloudError):
+                    sleep(_repeat * 2 + 1)
+            else:
+                failed.append(source)
+        return failed
+
+    def _delete_batch(self, names):
+        """Delete names using one batch request.
+
+        Returns dict name -> True if the object was deleted (or did not
+        exist anymore), False otherwise.
+        """
+        for _repeat in range(6):
+            try:
+                handle = self._thread_handle(reconnect=_repeat > 0)
+                with handle.client.batch():
+                    for name in names:
+                        handle.delete_blob(name)
+                return dict((name, True) for name in names)
+            except exceptions.NotFound:
+                # The other deletes of the batch ran, finish() raises only
+                # the error of a missing object. Results of the objects are
+                # unknown, so they are deleted (or found missing) one by one.
+                break
+            except (IOError, BadStatusLine, ResponseNotReady,
+                    exceptions.GCloudError):
+                sleep(_repeat * 2 + 1)
+        results = {}
+        for name in names:
+            for _repeat in range(6):
+                try:
+                    handle = self._thread_handle(reconnect=_repeat > 0)
+                    handle.delete_blob(name)
+                    results[name] = True
+                    break
+                except exceptions.NotFound:
+                    results[name] = True
+                    break
+                except (IOError, BadStatusLine, ResponseNotReady,
+                        exceptions.GCloudError):
+                    sleep(_repeat * 2 + 1)
+            else:
+                results[name] = False
+        return results
+
+    def _listing(self, prefix):
+        """Return dict name -> crc32c for all objects with prefix."""
+        for _repeat in range(6):
+            try:
+                handle = self._thread_handle(reconnect=_repeat > 0)
+                return dict(
+                    (key.name, key.crc32c)
+                    for key in handle.list_blobs(prefix=prefix))
+            except (IOError, BadStatusLine, ResponseNotReady,
+                    exceptions.GCloudError):
+                sleep(_repeat * 2 + 1)
+        raise Exception("Cannot list prefix {} in the bucket {}!".format(
+            prefix, self.name))
+
     def crc32c_hash_b64encode(self, crc32c_hash):
         return base64.b64encode(struct.pack(">I", crc32c_hash)).decode("utf-8")
 
+    def _download_raw(self, blob, fileobj):
+        """Download the stored bytes of blob, without decompression.
+
+        httplib2 of the gcloud client decompresses gzip responses,
+        so the object is read by urllib with the access token of the client.
+        """
+        if blob.media_link is None:
+            blob.reload()
+        credentials = self.handle.client._connection.credentials
+        request = Request(blob.media_link, headers={
+            'Authorization': 'Bearer {}'.format(
+                credentials.get_access_token().access_token),
+            # GCS does not transcode for clients accepting gzip
+            'Accept-Encoding': 'gzip',
+        })
+        response = urlopen(request)
+        try:
+            chunk = response.read(self.DOWNLOAD_CHUNK_SIZE)
+            while chunk:
+                fileobj.write(chunk)
+                chunk = response.read(self.DOWNLOAD_CHUNK_SIZE)
+        finally:
+            response.close()
+
     def download_with_verification(self, blob, target):
         source_blob_crc32c = blob.crc32c
         if not os.path.exists(target):
             with open(target, "wb") as blob_file:
                 parser = Crc32cCalculator(blob_file)
-                blob.download_to_file(parser)
+                if blob.content_encoding:
+                    # Stored (compressed) bytes, as verified by crc32c
+                    self._download_raw(blob, parser)
+                else:
+                    blob.download_to_file(parser)
 
             if self.crc32c_hash_b64encode(parser.crc32._crc) != source_blob_crc32c:
                 os.remove(target)
                 raise DifferentHashException("The hash of source and target are different.")
 
-    def put(self, source, target):
+    def put(self, source, target, compress=None, content_type=None):
+        """Put the source file into the bucket.
+
+        @param compress - 'gzip' or 'br', compress objects of text-like
+                          types (see COMPRESS_TYPES) on the fly and set
+                          their Content-Encoding.
+        """
+        if not (compress and self.compressible(target)):
+            return self._put(source, target, content_type)
+        crc = [0]
+
+        def update_crc(chunk):
+            crc[0] = crc32c.crc32c(chunk, crc[0])
+
+        # Hashes are computed over the stored (compressed) bytes
+        compressed, md5 = self.compress(source, compress, update_crc)
+        try:
+            self._put(
+                compressed, target,
+                content_type or self.content_type(target),
+                content_encoding=compress, crc32=crc[0], md5=md5)
+        finally:
+            os.remove(compressed)
+
+    def _put(self, source, target, content_type=None, content_encoding=None,
+             crc32=None, md5=None):
+        if crc32 is None:
+            with open(source, "rb") as blob_file:
+                crc32 = crc32c.crc32c(blob_file.read())
         last_ex = None
         for _repeat in range(6):
             try:
                 key = self.handle.blob(target, chunk_size=self.CHUNK_SIZE)
-                with open(source, "rb") as blob_file:
-                    crc32 = crc32c.crc32c(blob_file.read())
                 key.crc32c = self.crc32c_hash_b64encode(crc32)
-                key.upload_from_filename(source)
+                key.upload_from_filename(source, content_type=content_type)
+                # The upload sends no metadata, check the stored object
+                if md5 is not None and key.md5_hash != md5[1]:
+                    raise DifferentHashException(
+                        "The hash of source and target are different.")
+                if content_encoding is not None:
+                    key.content_encoding = content_encoding
+                    key.patch()
                 break
             except (IOError, BadStatusLine, exceptions.GCloudError, exceptions.BadRequest) as ex:
                 sleep(_repeat * 2 + 1)
@@ -136,20 +337,24 @@ class Bucket(BaseBucket):
                 str(last_ex)))
 
     def get(self, source, target):
+        """Download the object into the target file.
+
+        Objects with Content-Encoding (see put()) are written as stored,
+        i.e. compressed, and verified by their crc32c.
+        """
         key = self.handle.get_blob(source)
         if key is None:
             raise Exception("Object {} not exists in bucket {}.".format(
                 source, self.handle.id))
         key.chunk_size = self.CHUNK_SIZE
         last_ex = None
-        for _repeat in range(6):
+        for _repeat in range(self.retries):
             try:
                 self.download_with_verification(key, target)
                 break
             except (IOError, DifferentHashException, BadStatusLine, exceptions.GCloudError) as ex:
-                sleep(_repeat * 2 + 1)
-                self._reconnect(self.name)
-                key = self.handle.get_blob(source)
+                if self._backoff(_repeat):
+                    key = self.handle.get_blob(source)
                 last_ex = ex
             except Exception as ex:
                 last_ex = ex
@@ -178,16 +383,103 @@ class Bucket(BaseBucket):
                     return self.has(target)
         return self.has(target)
 
-    def has(self, source):
+    def rename_prefix(self, source, target, workers=16):
+        """Move all objects with prefix source under prefix target.
+
+        Objects are copied server-side by a pool of workers, verified
+        against a listing of target (crc32c) and only then deleted
+        from source in batches.
+        The method is idempotent - running it again after a crash
+        skips objects already present in target and finishes the move.
+        When target starts with source (e.g. 'tiles' -> 'tiles_v2'),
+        objects already under target are not moved again.
+        """
+        if source == target:
+            raise Exception("Cannot rename prefix {} to itself!".format(source))
+        sources = self._listing(source)
+        if target.startswith(source):
+            sources = dict(
+                (name, crc) for name, crc in sources.items()
+                if not name.startswith(target))
+        targets = self._listing(target)
+        pairs = []
+        for name, crc in sources.items():
+            new_name = target + name[len(source):]
+            if targets.get(new_name) != crc:
+                pairs.append((name, new_name))
+
+        pool = ThreadPool(workers)
+        try:
+            failed = []
+            # One copy per task, BATCH_SIZE limits only delete batches
+            for result in pool.imap_unordered(
+                    self._copy, ([pair] for pair in pairs)):
+                failed.extend(result)
+
+            # Verify copies from one listing, no per-object requests
+            targets = self._listing(target)
+            verified = [
+                name for name, crc in sources.items()
+                if targets.get(target + name[len(source):]) == crc]
+
+            for result in pool.imap_unordered(
+                    self._delete_batch, chunks(verified, self.BATCH_SIZE)):
+                failed.extend(
+                    name for name, deleted in result.items() if not deleted)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Final pass: nothing of the moved objects stays in source
+        remaining = self._listing(source)
+        missing = [
+            name for name in sources
+            if name in remaining or target + name[len(source):] not in targets]
+        return not failed and not missing
+
+    def delete(self, source):
+        return self._delete_batch([source])[source]
+
+    def delete_many(self, sources, workers=16):
+        """Delete objects using concurrent batch requests.
+
+        Sources may be any iterable (also a streaming listing).
+        Returns dict name -> True if the object was deleted
+        or did not exist, False otherwise.
+        """
+        results = {}
+        pool = ThreadPool(workers)
+        try:
+            for result in pool.imap_unordered(
+                    self._delete_batch, chunks(sources, self.BATCH_SIZE)):
+                results.update(result)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def delete_prefix(self, prefix, workers=16):
+        return self.delete_many(
+            (key.name for key in self.list(prefix)), workers=workers)
+
+    def exists(self, source):
+        """Return True if the object exists, raise on persistent errors."""
         key = self.handle.blob(source)
-        for _repeat in range(6):
+        last_ex = None
+        for _repeat in range(self.retries):
             try:
                 return key.exists()
-            except:
-                sleep(_repeat * 2 + 1)
-                self._reconnect(self.name)
-                key = self.handle.blob(source)
-        else:
+            except Exception as ex:
+                last_ex = ex
+                if self._backoff(_repeat):
+                    key = self.handle.blob(source)
+        raise Exception("Cannot check object {} in the bucket {}: {}!".format(
+            source, self.name, str(last_ex)))
+
+    def has(self, source):
+        try:
+            return self.exists(source)
+        except Exception:
             return False
 
     def list(self, prefix=None):
@@ -195,24 +487,22 @@ class Bucket(BaseBucket):
             yield key
 
     def size(self, source):
-        for _repeat in range(6):
+        for _repeat in range(self.retries):
             try:
                 key = self.handle.get_blob(source)
                 return key.size if key is not None else 0
             except (IOError, BadStatusLine, exceptions.GCloudError):
-                sleep(_repeat * 2 + 1)
-                self._reconnect(self.name)
+                self._backoff(_repeat)
 
     def is_public(self, source):
-        for _repeat in range(6):
+        for _repeat in range(self.retries):
             try:
                 key = self.handle.get_blob(source)
                 if key is None:
                     return False
                 return 'READER' in key.acl.all().get_roles()
             except (IOError, BadStatusLine, exceptions.GCloudError):
-                sleep(_repeat * 2 + 1)
-                self._reconnect(self.name)
+                self._backoff(_repeat)
             except:
                 pass
 
@@ -232,7 +522,69 @@ class Bucket(BaseBucket):
     def is_remote(self, source):
         return True
 
+    def _url_path(self, source):
+        return '/{}/{}'.format(
+            self.name, quote(source.encode('utf-8'), safe='/~'))
+
+    def public_url(self, source):
+        """Return public URL of the object, computed without any request."""
+        return 'https://{}{}'.format(self.URL_HOST, self._url_path(source))
+
+    def signed_url(self, source, expiration=3600, method='GET',
+                   credentials=None):
+        """Return V4 signed URL of the object, computed locally.
+
+        @param expiration - validity of the URL in seconds (max 7 days).
+        @param credentials - service account credentials, default are the
+                             credentials of the bucket connection.
+        """
+        credentials = credentials or self.credentials
+        if credentials is None:
+            raise Exception('Signed URL requires service account credentials.')
+        expiration = int(expiration)
+        if not 0 < expiration <= self.URL_MAX_EXPIRATION:
+            raise Exception(
+                'Expiration must be between 1 and {} seconds.'.format(
+                    self.URL_MAX_EXPIRATION))
+
+        now = datetime.datetime.utcnow()
+        request_timestamp = now.strftime('%Y%m%dT%H%M%SZ')
+        credential_scope = '{}/auto/storage/goog4_request'.format(
+            now.strftime('%Y%m%d'))
+        query = {
+            'X-Goog-Algorithm': 'GOOG4-RSA-SHA256',
+            'X-Goog-Credential': '{}/{}'.format(
+                credentials.service_account_email, credential_scope),
+            'X-Goog-Date': request_timestamp,
+            'X-Goog-Expires': str(expiration),
+            'X-Goog-SignedHeaders': 'host',
+        }
+        query_string = '&'.join(
+            '{}={}'.format(quote(k, safe='~'), quote(query[k], safe='~'))
+            for k in sorted(query))
+        path = self._url_path(source)
+        canonical_request = '\n'.join([
+            method,
+            path,
+            query_string,
+            'host:{}\n'.format(self.URL_HOST),
+            'host',
+            'UNSIGNED-PAYLOAD',
+        ])
+        string_to_sign = '\n'.join([
+            'GOOG4-RSA-SHA256',
+            request_timestamp,
+            credential_scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ])
+        _, signature = credentials.sign_blob(string_to_sign)
+        return 'https://{}{}?{}&X-Goog-Signature={}'.format(
+            self.URL_HOST, path, query_string,
+            binascii.hexlify(signature).decode('ascii'))
+
     def get_public_url(self, source):
+        if self.public:
+            return self.public_url(source)
         if self.has(source):
             key = self.handle.blob(source)
             return key.public_url if self.is_public(source) else None
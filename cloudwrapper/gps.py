@@ -7,6 +7,8 @@ Author: Martin Mikita <martin.mikita@klokantech.com>
 import base64
 import json
 import sys
+import threading
+from datetime import datetime
 from time import sleep, time
 
 if sys.version[0] == '2':
@@ -14,8 +16,12 @@ if sys.version[0] == '2':
 else:
     from queue import Empty
 
+from .base import (
+    Backoff, BaseMessage, BaseQueue, PeriodicThread, StatsCache, chunks)
+
 try:
     from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
     from oauth2client.client import GoogleCredentials
     from .gce import GoogleComputeEngine
 except ImportError:
@@ -30,6 +36,10 @@ except ImportError:
     raise
 
 
+def _rfc3339(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
 class GpsConnection(object):
 
     def __init__(self):
@@ -42,10 +52,138 @@ class GpsConnection(object):
             name, self.client,
             self.credentials, self.gce.projectId())
 
-    def subscription(self, name):
+    def subscription(self, name, **options):
         return Subscription(
             name, self.client,
-            self.credentials, self.gce.projectId())
+            self.credentials, self.gce.projectId(), **options)
+
+
+class PublishFuture(object):
+    """Result of a batched publish, resolved to the message id."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise Exception('Message not published in {} seconds.'.format(
+                timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class Publisher(object):
+    """
+    Batching publisher of a topic.
+
+    Messages are collected up to the PubSub limits (max_messages,
+    max_bytes of encoded data) and published by one request when a batch
+    is full or after linger seconds from a background thread.
+    """
+
+    MAX_MESSAGES = 1000
+    MAX_BYTES = (10 << 20) - (64 << 10)  # 10 MB minus request framing
+
+    def __init__(self, topic, max_messages=MAX_MESSAGES, max_bytes=MAX_BYTES,
+                 linger=0.05):
+        self.topic = topic
+        self.max_messages = min(max_messages, self.MAX_MESSAGES)
+        self.max_bytes = min(max_bytes, self.MAX_BYTES)
+        self.pending = []
+        self.pending_bytes = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = PeriodicThread(linger, self.flush)
+        self._thread.start()
+
+    def _api(self):
+        # API clients are not thread-safe
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = self._local.api = build(
+                'pubsub', 'v1', credentials=self.topic.credentials)
+        return api
+
+    def publish(self, message):
+        """Add message to the batch, return PublishFuture of its id."""
+        data = self.topic._encode(message)
+        size = len(data) + 16  # JSON framing of the message
+        if size > self.max_bytes:
+            raise Exception('Message is larger than {} bytes.'.format(
+                self.max_bytes))
+        future = PublishFuture()
+        with self._lock:
+            self.pending.append((data, size, future))
+            self.pending_bytes += size
+            full = (len(self.pending) >= self.max_messages or
+                    self.pending_bytes >= self.max_bytes)
+        if full:
+            self.flush()
+        return future
+
+    def _take_batch(self):
+        """Remove one batch of collected messages (under _lock)."""
+        size = 0
+        count = 0
+        for _data, message_size, _future in self.pending:
+            if (count == self.max_messages or
+                    size + message_size > self.max_bytes):
+                break
+            size += message_size
+            count += 1
+        batch = self.pending[:count]
+        del self.pending[:count]
+        self.pending_bytes -= size
+        return batch
+
+    def _send(self, batch):
+        body = {
+            "messages": [{"data": data} for data, _size, _future in batch],
+        }
+        try:
+            resp = self._api().projects().topics().publish(
+                topic=self.topic.topicId,
+                body=body).execute(num_retries=6)
+            for (_data, _size, future), message_id in zip(
+                    batch, resp.get('messageIds', [])):
+                future.set_result(message_id)
+        except Exception as ex:
+            for _data, _size, future in batch:
+                future.set_exception(ex)
+        # Response without ids for all messages
+        for _data, _size, future in batch:
+            if not future.done():
+                future.set_exception(Exception('Message not published.'))
+
+    def flush(self):
+        """Publish all collected messages."""
+        with self._send_lock:
+            while True:
+                with self._lock:
+                    batch = self._take_batch()
+                if not batch:
+                    break
+                self._send(batch)
+
+    def close(self):
+        """Stop the background thread and publish collected messages."""
+        self._thread.stop()
+        self.flush()
 
 
 class Topic(object):
@@ -56,6 +194,20 @@ class Topic(object):
         self.credentials = credentials
         self.projectId = projectId
         self.topicId = 'projects/{}/topics/{}'.format(self.projectId, name)
+        self.publisher = None
+
+    def batch(self, max_messages=Publisher.MAX_MESSAGES,
+              max_bytes=Publisher.MAX_BYTES, linger=0.05):
+        """Use batching Publisher for put(), return it."""
+        if self.publisher is not None:
+            self.publisher.close()
+        self.publisher = Publisher(self, max_messages, max_bytes, linger)
+        return self.publisher
+
+    def close(self):
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
 
     def _encode(self, message):
         msg_json = json.dumps(message, separators=(',', ':'))
@@ -81,23 +233,117 @@ class Topic(object):
 
         Note that PubSub doesn't implement non-blocking or timeouts for writes,
         so both 'block' and 'timeout' must have their default values only.
+
+        With batch() enabled, returns PublishFuture of the message id.
         """
         if not (block and timeout is None):
             raise Exception('GpubsubConnection::Topic::put() '
                             '- Block and timeout must have default values.')
+        if self.publisher is not None:
+            return self.publisher.publish(item)
         self.publish(item)
 
 
-class Subscription(object):
-
-    def __init__(self, name, handle, credentials, projectId):
+class Message(BaseMessage):
+    """Handle of one pulled message."""
+
+    def __init__(self, subscription, received):
+        message = received.get('message')
+        data = message.get('data')
+        super(Message, self).__init__(
+            subscription._decode(str(data)) if data else None)
+        self.subscription = subscription
+        self.ack_id = received.get('ackId')
+        self.message_id = message.get('messageId')
+        self.attributes = message.get('attributes', {})
+
+    def ack(self):
+        self.subscription._untrack(self.ack_id)
+        self.subscription._buffer_ack(self.ack_id)
+
+    def extend(self, lease_time=600):
+        self.subscription._modify_deadline([self.ack_id], lease_time)
+        self.subscription._extended([self.ack_id], lease_time)
+
+    def nack(self, delay=0):
+        """Return the message, redelivered after delay seconds."""
+        self.subscription._untrack(self.ack_id)
+        self.subscription._buffer_ack(self.ack_id, delay)
+
+
+class Subscription(BaseQueue):
+    """
+    Google PubSub subscription.
+
+    Blocking pull() waits on the server (returnImmediately is False)
+    and polls with exponential backoff when that returns no message,
+    see setPollingOptions().
+
+    pull_many() returns Message handles. Their acks and nacks are
+    buffered and sent in batches of up to ACK_BATCH ids after ack_linger
+    seconds (or when a batch is full), close() sends the rest.
+    Failed batches are sent again, ackIds rejected by the server (4xx)
+    or failing ACK_RETRIES times are kept in unacked, flush_acks()
+    (or close()) raises when there are any unacked ones.
+
+    With lease_time (seconds), a background lease manager extends the ack
+    deadline of all pulled and not yet acknowledged messages to lease_time,
+    a third of it before they expire, by batched modifyAckDeadline calls.
+    No message is extended for longer than max_lease seconds since it was
+    pulled, so stuck handlers do not hold messages forever.
+
+    qsize() and has_available() read the backlog metric of the subscription
+    from Cloud Monitoring, instead of pulling messages. The value is cached
+    for stats_ttl seconds, shared within the process and, with
+    stats_cache_dir, by all processes on the host.
+    """
+
+    MAX_MESSAGES = 1000  # Messages in one pull
+    ACK_BATCH = 1000  # ackIds in one acknowledge or modifyAckDeadline
+    ACK_RETRIES = 5  # Failed sends of one ackId before it is given up
+    MAX_DEADLINE = 600
+    BACKLOG_METRIC = (
+        'pubsub.googleapis.com/subscription/num_undelivered_messages')
+
+    def __init__(self, name, handle, credentials, projectId, ack_linger=0.1,
+                 lease_time=None, max_lease=3600, stats_ttl=60,
+                 stats_cache_dir=None):
         self.name = name
         self.handle = handle
         self.credentials = credentials
         self.projectId = projectId
         self.subscriptionId = 'projects/{}/subscriptions/{}'.format(
             self.projectId, name)
-        self.available_timestamp = None
+        self.stats_cache = StatsCache(stats_ttl, stats_cache_dir)
+        self.long_poll = True
+        self.polling = Backoff()
+        self.message = None
+        self.ack_linger = ack_linger
+        self.acks = []
+        self.nacks = {}  # delay -> ackIds
+        self.unacked = []  # ackId, error
+        self._ack_failures = {}  # ackId -> failed sends
+        self._ack_lock = threading.Lock()
+        self._ack_thread = None
+        self._local = threading.local()
+
+        # Longer deadlines are cut by the server
+        self.lease_time = lease_time and min(lease_time, self.MAX_DEADLINE)
+        self.max_lease = max_lease
+        self.ack_deadline = None
+        self.leases = {}  # ackId -> [pulled, deadline]
+        self._lease_lock = threading.Lock()
+        self._lease_thread = None
+        if lease_time:
+            self._lease_thread = PeriodicThread(1, self._extend_leases)
+            self._lease_thread.start()
+
+    def setPollingOptions(self, minimum=0.5, maximum=20, factor=2,
+                          jitter=0.5, long_poll=True):
+        # Arguments: first and maximal interval [s], its growth and jitter,
+        # long_poll - blocking pulls wait on the server
+        self.polling = Backoff(minimum, maximum, factor, jitter)
+        self.long_poll = long_poll
 
     def _decode(self, message):
         msg_json = json.dumps(message, separators=(',', ':'))
@@ -123,44 +369,255 @@ class Subscription(object):
                 if msg:
                     yield self._decode(str(msg.get('data')))
 
-    def _get_message(self, block=True):
-        """Internal pull one message from the subscriber."""
+    def _api(self):
+        # API clients are not thread-safe
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = self._local.api = build(
+                'pubsub', 'v1', credentials=self.credentials)
+        return api
+
+    def _pull(self, max_messages, block, api=None):
+        """Internal pull up to max_messages received messages."""
         body = {
-            "returnImmediately": not block,
-            "maxMessages": 1,
+            "returnImmediately": not (block and self.long_poll),
+            "maxMessages": min(max_messages, self.MAX_MESSAGES),
         }
-        resp = self.handle.projects().subscriptions().pull(
+        resp = (api or self.handle).projects().subscriptions().pull(
             subscription=self.subscriptionId,
             body=body).execute(num_retries=6)
-        receivedMessages = resp.get('receivedMessages')
-        if receivedMessages is not None:
-            for message in receivedMessages:
-                msg = message.get('message')
-                if msg:
-                    return message
+        received = [
+            message for message in resp.get('receivedMessages') or []
+            if message.get('message')]
+        if received and self._lease_thread is not None:
+            now = time()
+            with self._lease_lock:
+                for message in received:
+                    self.leases[message.get('ackId')] = [now, None]
+        return received
+
+    def _get_message(self, block=True):
+        """Internal pull one message from the subscriber."""
+        for message in self._pull(1, block):
+            return message
         return None
 
-    def pull(self, block=True, timeout=None):
-        """Pull one message from the subscriber."""
+    def pull_many(self, max_messages=100, block=True, timeout=None):
+        """Pull up to max_messages messages, return Message handles.
+
+        Handles are acknowledged by their own ack(), extend() or nack().
+        """
+        received = self._pull(max_messages, block, self._api())
+        if block:
+            while not received:
+                sleep(timeout if timeout is not None else self.polling.next())
+                received = self._pull(max_messages, block, self._api())
+
+        if not received:
+            raise Empty
+        self.polling.reset()
+        return [Message(self, message) for message in received]
+
+    def pull(self, block=True, timeout=None, handle=False):
+        """Pull one message from the subscriber.
+
+        With handle, return Message handle of the message instead.
+        """
+        if handle:
+            self.message = None
+            return self.pull_many(1, block, timeout)[0]
         self.message = self._get_message(block)
         if block:
             while self.message is None:
-                sleep()
-                # Sleep at least 20 seconds before next message receive
-                sleep(timeout if timeout is not None else 20)
+                sleep(timeout if timeout is not None else self.polling.next())
                 self.message = self._get_message(block)
 
         if self.message is None:
             raise Empty
+        self.polling.reset()
         data = self.message.get('message').get('data')
         if not data:
             raise Empty
 
         return self._decode(str(data))
 
-    def get(self, block=True, timeout=None):
+    def get(self, block=True, timeout=None, handle=False):
         """Get (pull) one message from the subscriber."""
-        return self.pull(block=block, timeout=timeout)
+        return self.pull(block=block, timeout=timeout, handle=handle)
+
+    def _acknowledge(self, ack_ids):
+        resp = self._api().projects().subscriptions().acknowledge(
+            subscription=self.subscriptionId,
+            body={"ackIds": ack_ids}).execute(num_retries=6)
+        # Response should be empty
+        if resp:
+            raise Exception(resp)
+
+    def _modify_deadline(self, ack_ids, lease_time):
+        body = {
+            "ackDeadlineSeconds": max(min(
+                int(lease_time), self.MAX_DEADLINE), 0),
+            "ackIds": ack_ids,
+        }
+        resp = self._api().projects().subscriptions().modifyAckDeadline(
+            subscription=self.subscriptionId,
+            body=body).execute(num_retries=6)
+        # Response should be empty
+        if resp:
+            raise Exception(resp)
+
+    def _buffer_ack(self, ack_id, delay=None):
+        """Buffer ack (delay is None) or nack of ack_id for flush_acks()."""
+        with self._ack_lock:
+            if delay is None:
+                ack_ids = self.acks
+            else:
+                ack_ids = self.nacks.setdefault(int(delay), [])
+            ack_ids.append(ack_id)
+            # Ids of failed flushes stay buffered, only a newly filled
+            # batch is sent here, the rest by the background thread
+            full = len(ack_ids) == self.ACK_BATCH
+            if self._ack_thread is None:
+                self._ack_thread = PeriodicThread(
+                    self.ack_linger, self._send_acks)
+                self._ack_thread.start()
+        if full:
+            # The rest of failed batches is sent by the background thread
+            self._send_acks()
+
+    def _send_acks(self):
+        """Send buffered acks and nacks, return errors of failed batches.
+
+        ackIds of failed batches stay buffered for the next send,
+        the rejected ones and those failing ACK_RETRIES times are moved
+        to unacked.
+        """
+        with self._ack_lock:
+            acks, self.acks = self.acks, []
+            nacks, self.nacks = self.nacks, {}
+        batches = [(None, batch) for batch in chunks(acks, self.ACK_BATCH)]
+        for delay, ack_ids in nacks.items():
+            batches.extend(
+                (delay, batch) for batch in chunks(ack_ids, self.ACK_BATCH))
+        errors = []
+        for delay, batch in batches:
+            try:
+                if delay is None:
+                    self._acknowledge(batch)
+                else:
+                    self._modify_deadline(batch, delay)
+            except Exception as ex:
+                errors.append(ex)
+                self._ack_failed(delay, batch, ex)
+                continue
+            if self._ack_failures:
+                with self._ack_lock:
+                    for ack_id in batch:
+                        self._ack_failures.pop(ack_id, None)
+        return errors
+
+    def _ack_failed(self, delay, batch, exception):
+        # Invalid or expired ackIds would be rejected again
+        rejected = (
+            isinstance(exception, HttpError) and
+            400 <= exception.resp.status < 500 and
+            exception.resp.status != 429)
+        retry = []
+        with self._ack_lock:
+            for ack_id in batch:
+                failures = self._ack_failures.pop(ack_id, 0) + 1
+                if rejected or failures >= self.ACK_RETRIES:
+                    self.unacked.append((ack_id, exception))
+                else:
+                    self._ack_failures[ack_id] = failures
+                    retry.append(ack_id)
+            if delay is None:
+                self.acks[:0] = retry
+            else:
+                self.nacks.setdefault(delay, [])[:0] = retry
+
+    def flush_acks(self):
+        """Send buffered acks and nacks of Message handles.
+
+        Raise if any ackId was given up, also by the background thread
+        (the exception has list of (ackId, error) in unacked), otherwise
+        the first error of batches which stay buffered.
+        """
+        errors = self._send_acks()
+        with self._ack_lock:
+            unacked, self.unacked = self.unacked, []
+        if unacked:
+            ex = Exception('{} ackIds not sent: {}'.format(
+                len(unacked), unacked[0][1]))
+            ex.unacked = unacked
+            raise ex
+        if errors:
+            raise errors[0]
+
+    def _untrack(self, ack_id):
+        with self._lease_lock:
+            self.leases.pop(ack_id, None)
+
+    def _extended(self, ack_ids, lease_time):
+        deadline = time() + min(lease_time, self.MAX_DEADLINE)
+        with self._lease_lock:
+            for ack_id in ack_ids:
+                if ack_id in self.leases:
+                    self.leases[ack_id][1] = deadline
+
+    def _get_ack_deadline(self):
+        if self.ack_deadline is None:
+            subscription = self._api().projects().subscriptions().get(
+                subscription=self.subscriptionId).execute(num_retries=6)
+            self.ack_deadline = int(
+                subscription.get('ackDeadlineSeconds', 10))
+        return self.ack_deadline
+
+    def _extend_leases(self):
+        """Extend ack deadlines of tracked messages close to expiration."""
+        ack_deadline = self._get_ack_deadline()
+        now = time()
+        margin = self.lease_time / 3.0
+        extend = {}  # lease time -> ackIds
+        with self._lease_lock:
+            for ack_id, lease in list(self.leases.items()):
+                pulled, deadline = lease
+                if deadline is None:
+                    deadline = lease[1] = pulled + ack_deadline
+                if deadline > now + margin:
+                    continue
+                lease_time = min(self.lease_time,
+                                 pulled + self.max_lease - now)
+                if lease_time < 1:
+                    # Held too long, let it expire and be redelivered
+                    del self.leases[ack_id]
+                    continue
+                extend.setdefault(int(lease_time), []).append(ack_id)
+        errors = []
+        for lease_time, ack_ids in extend.items():
+            for batch in chunks(ack_ids, self.ACK_BATCH):
+                try:
+                    self._modify_deadline(batch, lease_time)
+                except Exception as ex:
+                    # Other batches are extended, these in the next tick
+                    errors.append(ex)
+                    continue
+                self._extended(batch, lease_time)
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        """Stop the lease manager, send buffered acks and nacks."""
+        if self._lease_thread is not None:
+            self._lease_thread.stop()
+            self._lease_thread = None
+        with self._lease_lock:
+            self.leases.clear()
+        with self._ack_lock:
+            thread, self._ack_thread = self._ack_thread, None
+        if thread is not None:
+            thread.stop()
+        self.flush_acks()
 
     def acknowledge(self):
         """Acknowledge that a formerly enqueued message is complete.
@@ -169,6 +626,7 @@ class Subscription(object):
         """
         if self.message is None:
             raise Exception('No message to acknowledge.')
+        self._untrack(self.message.get('ackId'))
         body = {
             "ackIds": [self.message.get('ackId')],
         }
@@ -203,35 +661,56 @@ class Subscription(object):
         # Response should be empty
         if resp:
             raise Exception(resp)
+        self._extended([msg.get('ackId')], lease_time)
 
-    def has_available(self):
-        """It is any message available for lease.
-
-        If there is no message, this state is cached internally for 5 minutes.
-        10 minutes is time used for Google Autoscaler.
-        """
-        now = time()
-        # We have cached False response
-        if self.available_timestamp is not None and now < self.available_timestamp:  # noqa
-            return False
-
-        # Get oldestTask from queue stats
+    def _load_backlog(self):
+        """Number of undelivered messages from Cloud Monitoring."""
+        end = time()
+        start = end - 600  # The metric is sampled every minute, with delay
         exc = None
         for _repeat in range(6):
             try:
-                msg = self._get_message(block=False)
+                resp = self._monitoring().projects().timeSeries().list(
+                    name='projects/{}'.format(self.projectId),
+                    filter=(
+                        'metric.type="{}" AND '
+                        'resource.labels.subscription_id="{}"').format(
+                            self.BACKLOG_METRIC, self.name),
+                    interval_startTime=_rfc3339(start),
+                    interval_endTime=_rfc3339(end),
+                ).execute(num_retries=6)
                 break
             except Exception as e:
-                sleep(_repeat * 2 + 1)
                 exc = e
+                sleep(_repeat * 2 + 1)
         else:
-            if exc is not None:
-                raise exc
-            return False
-        # There is at least one availabe task
-        if msg is not None:
-            self.update(lease_time=2, msg=msg)
-            return True
-        # No available task, cache this response for 5 minutes
-        self.available_timestamp = now + 300  # 5 minutes
-        return False
+            raise exc
+        for series in resp.get('timeSeries', []):
+            # Points are ordered from the newest one
+            for point in series.get('points', []):
+                return int(point['value']['int64Value'])
+        return 0
+
+    def _monitoring(self):
+        # API clients are not thread-safe
+        api = getattr(self._local, 'monitoring', None)
+        if api is None:
+            api = self._local.monitoring = build(
+                'monitoring', 'v3', credentials=self.credentials)
+        return api
+
+    def qsize(self):
+        """Number of undelivered messages.
+
+        Taken from the subscription backlog metric, which is up to a few
+        minutes old. Cached for stats_ttl seconds, see the class docstring.
+        """
+        return self.stats_cache.get(
+            'gps:{}'.format(self.subscriptionId), self._load_backlog)
+
+    def has_available(self):
+        """It is any message available for lease.
+
+        Does not pull any message, see qsize().
+        """
+        return self.qsize() > 0
@@ -4,12 +4,16 @@ Copyright (C) 2016-2020 Klokan Technologies GmbH (http://www.klokantech.com/)
 Author: Martin Mikita <martin.mikita@klokantech.com>
 """
 
+import base64
 import json
 import errno
 import sys
+import threading
 
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from time import sleep, time
-from .base import BaseQueue
+from .base import BaseQueue, BaseMessage, Backoff
 
 if sys.version[0] == '2':
     from Queue import Empty
@@ -39,8 +43,29 @@ class GtqConnection(object):
     def __init__(self):
         self.client = Client()
 
-    def queue(self, name):
-        return Queue(Taskqueue(client=self.client, id=name), self.client)
+    def queue(self, name, **options):
+        return Queue(
+            Taskqueue(client=self.client, id=name), self.client, **options)
+
+
+class Task(BaseMessage):
+    """Handle of one leased task."""
+
+    def __init__(self, queue, task, expires=None):
+        super(Task, self).__init__(json.loads(task.description))
+        self.queue = queue
+        self.task = task
+        self.expires = expires
+
+    def ack(self):
+        self.queue._delete(self.task)
+
+    def extend(self, lease_time=600):
+        self.queue._update(self.task, lease_time)
+
+    def nack(self, delay=0):
+        """Return the task to the queue, available again after delay."""
+        self.queue._update(self.task, delay)
 
 
 class Queue(BaseQueue):
@@ -51,15 +76,35 @@ class Queue(BaseQueue):
     calling task_done(). Otherwise they will appear back in the
     queue, after a period of time called 'visibility time'. This
     parameter, and others, are configured outside this module.
+
+    With lease_batch > 1, up to lease_batch tasks are leased by one call
+    into a local buffer and get() serves them. Buffered tasks close
+    to the end of their lease (release_margin) are released, close()
+    releases the rest by setting their lease time to 0.
+
+    Blocking get() polls an empty queue with exponential backoff,
+    see setPollingOptions().
     """
 
-    def __init__(self, handle, client):
+    BATCH_SIZE = 100  # Calls in one HTTP batch request
+
+    def __init__(self, handle, client, lease_batch=1, release_margin=10):
         self.handle = handle
         self.client = client
         self.message = None
         self.available_timestamp = None
+        self.lease_batch = max(int(lease_batch or 1), 1)
+        self.release_margin = release_margin
+        self.buffer = deque()
+        self.polling = Backoff()
+        self._local = threading.local()
         self._reconnect()
 
+    def setPollingOptions(self, minimum=0.5, maximum=20, factor=2,
+                          jitter=0.5):
+        # Arguments: first and maximal interval [s], its growth and jitter
+        self.polling = Backoff(minimum, maximum, factor, jitter)
+
     def _reconnect(self):
         credentials = GoogleCredentials.get_application_default()
         self.handle_api = build(
@@ -104,51 +149,145 @@ class Queue(BaseQueue):
             except GCloudError:
                 sleep(_repeat * 2 + 5)
 
-    def _get_message(self, lease_time):
-        """Get one message with lease_time."""
+    def _thread_api(self, reconnect=False):
+        """API client of the current thread, clients are not thread-safe."""
+        api = getattr(self._local, 'api', None)
+        if api is None or reconnect:
+            api = self._local.api = build(
+                'taskqueue', 'v1beta2',
+                credentials=GoogleCredentials.get_application_default())
+        return api
+
+    def _insert_batch(self, entries):
+        """Insert (index, item) entries by one HTTP batch request.
+
+        Only failed inserts are sent again.
+        Returns dict index -> task id or exception.
+        """
+        results = {}
+        pending = entries
         for _repeat in range(6):
+            api = self._thread_api(reconnect=_repeat > 0)
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    results[int(request_id)] = exception
+                else:
+                    results[int(request_id)] = response.get('id')
+
+            batch = api.new_batch_http_request(callback=callback)
+            for index, item in pending:
+                payload = json.dumps(item, separators=(',', ':'))
+                batch.add(api.tasks().insert(
+                    project=self.handle.project,
+                    taskqueue=self.handle.id,
+                    body={
+                        'queueName': self.handle.full_name,
+                        'payloadBase64': base64.b64encode(
+                            payload.encode('utf-8')).decode('ascii'),
+                    }), request_id=str(index))
             try:
-                for task in self.handle.lease(
-                        lease_time=lease_time,
-                        num_tasks=1, client=self.client):
-                    return task
-                return None
+                batch.execute()
+            except Exception as ex:
+                for index, _item in pending:
+                    results.setdefault(index, ex)
+            pending = [
+                (index, item) for index, item in pending
+                if isinstance(results.get(index), Exception)]
+            # The last errors stay in results
+            if not pending or _repeat == 5:
+                break
+            for index, _item in pending:
+                del results[index]
+            sleep(_repeat * 2 + 1)
+        return results
+
+    def put_many(self, items, workers=4):
+        """Put many items into the queue using HTTP batch requests.
+
+        Batches of BATCH_SIZE inserts are sent by up to workers threads.
+        Returns list with task id or exception for every item.
+        """
+        entries = list(enumerate(items))
+        batches = [
+            entries[offset:offset + self.BATCH_SIZE]
+            for offset in range(0, len(entries), self.BATCH_SIZE)]
+        results = {}
+        pool = ThreadPool(workers)
+        try:
+            for result in pool.imap_unordered(self._insert_batch, batches):
+                results.update(result)
+        finally:
+            pool.close()
+            pool.join()
+        return [results[index] for index, _item in entries]
+
+    def _lease(self, lease_time, num_tasks):
+        for _repeat in range(6):
+            try:
+                return list(self.handle.lease(
+                    lease_time=lease_time,
+                    num_tasks=num_tasks, client=self.client))
             except IOError as e:
                 sleep(_repeat * 2 + 1)
                 if e.errno == errno.EPIPE:
                     self.client = Client()
             except GCloudError:
                 sleep(_repeat * 2 + 5)
+        return []
+
+    def _get_message(self, lease_time):
+        """Get one message with lease_time."""
+        if self.lease_batch == 1:
+            for task in self._lease(lease_time, 1):
+                return Task(self, task)
+            return None
+        self._release_expiring()
+        if not self.buffer:
+            expires = time() + lease_time
+            for task in self._lease(lease_time, self.lease_batch):
+                self.buffer.append(Task(self, task, expires))
+        if self.buffer:
+            return self.buffer.popleft()
+        return None
 
-    def get(self, block=True, timeout=None, lease_time=3600):
+    def _release_expiring(self):
+        deadline = time() + self.release_margin
+        while self.buffer and self.buffer[0].expires <= deadline:
+            self.buffer.popleft().nack()
+
+    def close(self):
+        """Release all buffered tasks back to the queue."""
+        while self.buffer:
+            self.buffer.popleft().nack()
+
+    def get(self, block=True, timeout=None, lease_time=3600, handle=False):
         """Get item from the queue.
 
         Default lease_time is 1 hour.
+        With handle, return Task handle of the item instead, which is
+        acknowledged by its own ack(), extend() or nack().
         """
-        self.message = self._get_message(lease_time)
+        self.message = None
+        message = self._get_message(lease_time)
         if block:
-            while self.message is None:
-                # Sleep at least 20 seconds before next message receive
-                sleep(timeout if timeout is not None else 20)
-                self.message = self._get_message(lease_time)
+            while message is None:
+                sleep(timeout if timeout is not None else self.polling.next())
+                message = self._get_message(lease_time)
 
-        if self.message is None:
+        if message is None:
             raise Empty
+        self.polling.reset()
 
-        return json.loads(self.message.description)
+        if handle:
+            return message
+        self.message = message
+        return message.body
 
-    def task_done(self):
-        """Acknowledge that a formerly enqueued task is complete.
-
-        Note that this method MUST be called for each item.
-        See the class docstring for details.
-        """
-        if self.message is None:
-            raise Exception('No message to acknowledge.')
+    def _delete(self, task):
         for _repeat in range(6):
             try:
-                self.message.delete(client=self.client)
-                self.message = None
+                task.delete(client=self.client)
                 break
             except IOError as e:
                 sleep(_repeat * 2 + 1)
@@ -157,14 +296,10 @@ class Queue(BaseQueue):
             except GCloudError:
                 sleep(_repeat * 2 + 5)
 
-    def update(self, lease_time=600):
-        """Update lease time for a formerly enqueued message."""
-        msg = self.message
-        if msg is None:
-            raise Exception('No message to update.')
+    def _update(self, task, lease_time):
         for _repeat in range(6):
             try:
-                self.message.update(lease_time, client=self.client)
+                task.update(lease_time, client=self.client)
                 break
             except IOError as e:
                 sleep(_repeat * 2 + 1)
@@ -173,6 +308,23 @@ class Queue(BaseQueue):
             except GCloudError:
                 sleep(_repeat * 2 + 5)
 
+    def task_done(self):
+        """Acknowledge that a formerly enqueued task is complete.
+
+        Note that this method MUST be called for each item.
+        See the class docstring for details.
+        """
+        if self.message is None:
+            raise Exception('No message to acknowledge.')
+        self.message.ack()
+        self.message = None
+
+    def update(self, lease_time=600):
+        """Update lease time for a formerly enqueued message."""
+        if self.message is None:
+            raise Exception('No message to update.')
+        self.message.extend(lease_time)
+
     def has_available(self):
         """It is any message available for lease.
 
@@ -0,0 +1,178 @@
+"""Read replicas of one bucket mirrored in multiple regions.
+
+ReplicaBucket
+
+Copyright (C) 2016-2020 Klokan Technologies GmbH (http://www.klokantech.com/)
+"""
+
+import copy
+import os
+import random
+import sys
+import threading
+
+from time import time
+
+from .base import BaseBucket
+
+if sys.version[0] == '2':
+    from httplib import HTTPException
+else:
+    from http.client import HTTPException
+
+
+class Replica(object):
+    """One replica bucket with its recent latency and errors."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.latency = None
+        self.errors = 0
+        self.failed_until = 0
+
+    def healthy(self, now):
+        return now >= self.failed_until
+
+
+class ReplicaBucket(BaseBucket):
+    """
+    Read-only bucket reading from the fastest healthy replica.
+
+    Replicas are any buckets (gcs.Bucket, s3.Bucket, ...) with the same
+    content. Latency of every replica is tracked as an exponentially
+    weighted moving average, failed replicas are skipped for a cooldown
+    period (doubled with every consecutive error) and reads fail over to
+    the next replica transparently.
+
+    Objects not mirrored to every replica yet are read from the others,
+    a missing object is not counted as a failure of the replica.
+    """
+
+    def __init__(self, buckets, alpha=0.2, cooldown=30, max_cooldown=600,
+                 explore=0.05, retries=1):
+        """
+        @param alpha - weight of the last measured latency.
+        @param cooldown - seconds to skip a replica after an error.
+        @param explore - probability to read from a random healthy replica
+                         to keep its latency up-to-date.
+        @param retries - attempts of one call of a replica bucket with its
+                         own retries (gcs.Bucket), the next replica is
+                         tried instead. The buckets passed are not changed.
+        """
+        if not buckets:
+            raise Exception('ReplicaBucket requires at least one bucket.')
+        self.replicas = [
+            Replica(self._with_retries(bucket, retries)) for bucket in buckets]
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.explore = explore
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _with_retries(bucket, retries):
+        if not hasattr(bucket, 'retries'):
+            return bucket
+        bucket = copy.copy(bucket)
+        bucket.retries = retries
+        return bucket
+
+    def _ordered(self):
+        now = time()
+        with self._lock:
+            healthy = [r for r in self.replicas if r.healthy(now)]
+            failed = [r for r in self.replicas if not r.healthy(now)]
+        # Not measured replicas first, then the fastest ones
+        healthy.sort(key=lambda r: -1 if r.latency is None else r.latency)
+        if len(healthy) > 1 and random.random() < self.explore:
+            healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+        # Failed replicas are the last resort, soonest recovered first
+        failed.sort(key=lambda r: r.failed_until)
+        return healthy + failed
+
+    def _success(self, replica, latency):
+        with self._lock:
+            if replica.latency is None:
+                replica.latency = latency
+            else:
+                replica.latency += self.alpha * (latency - replica.latency)
+            replica.errors = 0
+            replica.failed_until = 0
+
+    def _failure(self, replica):
+        with self._lock:
+            replica.errors += 1
+            replica.failed_until = time() + min(
+                self.cooldown * (2 ** (replica.errors - 1)), self.max_cooldown)
+
+    def _missing(self, replica, source, exception):
+        """The replica answers that the source does not exist (yet)."""
+        if isinstance(exception, (IOError, HTTPException)):
+            # Transport error, the replica would not answer either
+            return False
+        try:
+            return not replica.bucket.exists(source)
+        except Exception:
+            return False
+
+    def _call(self, method, source, *args, **kwargs):
+        """Call method of the first replica able to answer.
+
+        @param on_failure - called after every failed call.
+        @param found - results for which other replicas are not asked,
+                       default is any result.
+        """
+        on_failure = kwargs.pop('on_failure', None)
+        found = kwargs.pop('found', None)
+        answered = False
+        last_ex = None
+        for replica in self._ordered():
+            start = time()
+            try:
+                result = getattr(replica.bucket, method)(
+                    source, *args, **kwargs)
+            except NotImplementedError as ex:
+                # Not supported by this type of bucket, not its failure
+                last_ex = ex
+                continue
+            except Exception as ex:
+                if on_failure is not None:
+                    on_failure()
+                if not self._missing(replica, source, ex):
+                    self._failure(replica)
+                last_ex = ex
+                continue
+            self._success(replica, time() - start)
+            if found is None or found(result):
+                return result
+            answered, last_result = True, result
+        if answered:
+            return last_result
+        raise Exception('All replicas failed to {}: {}!'.format(
+            method, str(last_ex)))
+
+    def stats(self):
+        """Return list of (bucket, latency, errors) of all replicas."""
+        with self._lock:
+            return [(r.bucket, r.latency, r.errors) for r in self.replicas]
+
+    def get(self, source, target):
+        def remove_partial():
+            # Buckets do not overwrite existing files
+            if os.path.exists(target):
+                os.remove(target)
+
+        return self._call('get', source, target, on_failure=remove_partial)
+
+    def has(self, source):
+        return self._call('exists', source, found=bool)
+
+    def size(self, source):
+        # Size of missing objects is 0
+        return self._call('size', source, found=bool)
+
+    def list(self, prefix=None):
+        return self._ordered()[0].bucket.list(prefix)
+
+    def is_public(self, source):
+        return self._call('is_public', source)
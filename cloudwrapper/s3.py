@@ -6,8 +6,12 @@ Author: Martin Mikita <martin.mikita@klokantech.com>
 """
 
 import os
+import threading
 
-from .base import BaseBucket
+from multiprocessing.pool import ThreadPool
+from time import sleep
+
+from .base import BaseBucket, chunks
 
 try:
     from boto.s3 import connect_to_region, connection
@@ -32,24 +36,33 @@ except NameError:
 class S3Connection(object):
 
     def __init__(self, region, key=None, secret=None, host=None, anon=None):
-        if region is None and host is not None:
-            self.connection = connection.S3Connection(
-                host=host,
-                aws_access_key_id=key,
-                aws_secret_access_key=secret,
-                anon=anon,
-                calling_format=ProtocolIndependentOrdinaryCallingFormat())
-        else:
-            self.connection = connect_to_region(
-                region,
-                aws_access_key_id=key,
-                aws_secret_access_key=secret,
+        self.region = region
+        self.key = key
+        self.secret = secret
+        self.host = host
+        self.anon = anon
+        self.connection = self._connect()
+
+    def _connect(self):
+        """Return a new boto connection."""
+        if self.region is None and self.host is not None:
+            return connection.S3Connection(
+                host=self.host,
+                aws_access_key_id=self.key,
+                aws_secret_access_key=self.secret,
+                anon=self.anon,
                 calling_format=ProtocolIndependentOrdinaryCallingFormat())
+        return connect_to_region(
+            self.region,
+            aws_access_key_id=self.key,
+            aws_secret_access_key=self.secret,
+            calling_format=ProtocolIndependentOrdinaryCallingFormat())
 
     def bucket(self, name, create=False):
         for _ in range(6):
             try:
-                return Bucket(self.connection.get_bucket(name))
+                return Bucket(
+                    self.connection.get_bucket(name), connect=self._connect)
             except S3ResponseError as se:
                 if se.status == 404 and create:
                     self.connection.create_bucket(name)
@@ -60,17 +73,62 @@ class S3Connection(object):
 class Bucket(BaseBucket):
 
     PART_LIMIT = (4 << 30)  # 4 GB
+    DELETE_LIMIT = 1000  # Keys in one multi-object delete request
 
-    def __init__(self, handle):
+    def __init__(self, handle, connect=None):
+        """
+        @param connect - function returning a new boto connection,
+                         used for connections of worker threads.
+        """
         self.handle = handle
+        self.connect = connect
+        self._local = threading.local()
+
+    def _thread_handle(self):
+        """Bucket handle owned by the current thread.
+
+        boto connections are not thread-safe, so every worker thread
+        gets its own one. Without connect, the bucket handle is used.
+        """
+        if self.connect is None:
+            return self.handle
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            handle = self.connect().get_bucket(
+                self.handle.name, validate=False)
+            self._local.handle = handle
+        return handle
+
+    def put(self, source, target, compress=None, content_type=None):
+        """Put the source file into the bucket.
+
+        @param compress - 'gzip' or 'br', compress objects of text-like
+                          types (see COMPRESS_TYPES) on the fly and set
+                          their Content-Encoding.
+        """
+        headers = {}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if not (compress and self.compressible(target)):
+            return self._put(source, target, headers)
+        compressed, md5 = self.compress(source, compress)
+        headers['Content-Encoding'] = compress
+        headers['Content-Type'] = content_type or self.content_type(target)
+        try:
+            # Content-MD5 is verified by S3 over the stored bytes
+            self._put(compressed, target, headers, md5)
+        finally:
+            os.remove(compressed)
 
-    def put(self, source, target):
+    def _put(self, source, target, headers, md5=None):
         key = self.handle.new_key(target)
         source_size = os.stat(source).st_size
         if source_size <= self.PART_LIMIT:
-            key.set_contents_from_filename(source)
+            key.set_contents_from_filename(
+                source, headers=headers or None, md5=md5)
             return
-        multipart = self.handle.initiate_multipart_upload(target)
+        multipart = self.handle.initiate_multipart_upload(
+            target, headers=headers or None)
         try:
             with open(source, 'rb') as fp:
                 offsets = xrange(0, source_size, self.PART_LIMIT)
@@ -91,6 +149,54 @@ class Bucket(BaseBucket):
         key = self.handle.get_key(source, validate=False)
         return key.exists()
 
+    def size(self, source):
+        key = self.handle.get_key(source)
+        return key.size if key is not None else 0
+
     def list(self, prefix=None):
         for key in self.handle.get_all_keys(prefix=prefix):
             yield key
+
+    def _delete_chunk(self, names):
+        results = dict((name, False) for name in names)
+        for _repeat in range(6):
+            try:
+                response = self._thread_handle().delete_keys(
+                    names, quiet=False)
+                break
+            except (IOError, S3ResponseError):
+                sleep(_repeat * 2 + 1)
+        else:
+            return results
+        for deleted in response.deleted:
+            results[deleted.key] = True
+        return results
+
+    def delete(self, source):
+        return self._delete_chunk([source])[source]
+
+    def delete_many(self, sources, workers=8):
+        """Delete objects using concurrent multi-object delete requests.
+
+        Sources may be any iterable (also a streaming listing).
+        Returns dict name -> True if the object was deleted, False otherwise.
+        Buckets without connect (not from S3Connection) delete serially.
+        """
+        if self.connect is None:
+            workers = 1
+        results = {}
+        pool = ThreadPool(workers)
+        try:
+            for result in pool.imap_unordered(
+                    self._delete_chunk, chunks(sources, self.DELETE_LIMIT)):
+                results.update(result)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def delete_prefix(self, prefix, workers=8):
+        # bucket.list() pages through the whole prefix lazily
+        return self.delete_many(
+            (key.name for key in self.handle.list(prefix=prefix)),
+            workers=workers)
@@ -5,8 +5,10 @@ Author: Vaclav Klusak <vaclav.klusak@klokantech.com>
 """
 
 import sys
+import threading
+from collections import deque
 from time import sleep, time
-from .base import BaseQueue
+from .base import BaseQueue, BaseMessage, PeriodicThread
 
 
 if sys.version[0] == '2':
@@ -27,6 +29,11 @@ except ImportError:
     raise
 
 
+def _sender_fault(error):
+    """Boto keeps SenderFault of batch result entries as 'true'/'false'."""
+    return str(error.get('sender_fault')).lower() == 'true'
+
+
 class SqsConnection(object):
 
     def __init__(self, region, key=None, secret=None):
@@ -35,8 +42,28 @@ class SqsConnection(object):
             aws_access_key_id=key,
             aws_secret_access_key=secret)
 
-    def queue(self, name):
-        return Queue(self.connection.get_queue(name))
+    def queue(self, name, **options):
+        return Queue(self.connection.get_queue(name), **options)
+
+
+class Message(BaseMessage):
+    """Handle of one received message."""
+
+    def __init__(self, queue, message):
+        super(Message, self).__init__(message.get_body())
+        self.queue = queue
+        self.message = message
+
+    def ack(self):
+        self.queue._delete(self.message)
+
+    def extend(self, lease_time=600):
+        self.queue._set_visibility(self.message, lease_time)
+
+    def nack(self, delay=0):
+        """Make the message visible again after delay seconds."""
+        self.queue._untrack(self.message)
+        self.queue._set_visibility(self.message, delay)
 
 
 class Queue(BaseQueue):
@@ -47,13 +74,325 @@ class Queue(BaseQueue):
     calling task_done(). Otherwise they will appear back in the
     queue, after a period of time called 'visibility time'. This
     parameter, and others, are configured outside this module.
+
+    With prefetch > 0, messages are received in batches (up to 10 per call)
+    into a local buffer of that depth and get() serves them without
+    a network call. Buffered messages whose visibility is about to expire
+    (release_margin seconds) are released back to the queue.
+
+    With batch_put, put() only collects items and sends them with
+    send_message_batch (10 messages, 256 KB), when the batch is full
+    or after linger seconds from a background thread. Items which cannot
+    be sent are kept in unsent, flush() (or close()) sends all collected
+    items and raises when there are any unsent ones.
+
+    With batch_ack, task_done() only collects messages and deletes them
+    with delete_message_batch, when 10 messages are collected or from
+    a background thread. No acknowledgement waits longer than ack_linger
+    seconds nor ack_fraction of the visibility timeout. Messages which
+    cannot be deleted are kept in unacked, flush_acks() (or close())
+    deletes all collected messages and raises when there are any
+    unacked ones.
+
+    With heartbeat (seconds), a background thread extends visibility of
+    all gotten and not yet acknowledged messages to heartbeat seconds,
+    every third of heartbeat or of the visibility timeout (the shorter
+    one), using change_message_visibility_batch. No message is extended
+    for longer than max_lease seconds since it was gotten, so messages
+    of crashed handlers are delivered again.
+
+    Call close() to release the buffer, send collected items
+    and acknowledgements when the queue is not used anymore.
     """
 
-    def __init__(self, handle):
+    MAX_MESSAGES = 10  # SQS limit of messages in one request
+    MAX_BATCH_SIZE = (256 << 10)  # SQS limit of payload in one request
+
+    def __init__(self, handle, prefetch=0, visibility_timeout=None,
+                 release_margin=10, batch_put=False, linger=0.05,
+                 batch_ack=False, ack_linger=1.0, ack_fraction=0.1,
+                 heartbeat=None, max_lease=3600):
         handle.set_message_class(JSONMessage)
         self.handle = handle
         self.message = None
         self.available_timestamp = None
+        self.prefetch = int(prefetch or 0)
+        self.visibility_timeout = visibility_timeout
+        self.release_margin = release_margin
+        self.buffer = deque()
+
+        self.outgoing = []
+        self.outgoing_size = 0
+        self.unsent = []  # (body, delay), error
+        self._put_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._put_thread = None
+        if batch_put:
+            self._put_thread = PeriodicThread(linger, self._send_outgoing)
+            self._put_thread.start()
+
+        self.acks = []
+        self.unacked = []  # message, error
+        self._ack_lock = threading.Lock()
+        self._ack_send_lock = threading.Lock()
+        self._ack_thread = None
+        if batch_ack:
+            interval = min(
+                ack_linger, ack_fraction * self._visibility_timeout())
+            self._ack_thread = PeriodicThread(interval, self._delete_acks)
+            self._ack_thread.start()
+
+        self.heartbeat = heartbeat
+        self.max_lease = max_lease
+        self.in_flight = {}  # id -> [gotten, message]
+        self._heartbeat_lock = threading.Lock()
+        self._heartbeat_thread = None
+        if heartbeat:
+            interval = min(heartbeat, self._visibility_timeout()) / 3.0
+            self._heartbeat_thread = PeriodicThread(
+                interval, self._extend_in_flight)
+            self._heartbeat_thread.start()
+
+    def _visibility_timeout(self):
+        if self.visibility_timeout is None:
+            self.visibility_timeout = int(self.handle.get_timeout())
+        return self.visibility_timeout
+
+    def _change_visibility(self, messages, timeout):
+        """Change visibility of messages in batches, return failed ones."""
+        failed = []
+        for offset in range(0, len(messages), self.MAX_MESSAGES):
+            batch = messages[offset:offset + self.MAX_MESSAGES]
+            for _repeat in range(6):
+                try:
+                    response = self.handle.change_message_visibility_batch(
+                        [(message, timeout) for message in batch])
+                    break
+                except IOError:
+                    sleep(_repeat * 2 + 1)
+            else:
+                failed.extend(batch)
+                continue
+            errors = set(error['id'] for error in response.errors)
+            failed.extend(
+                message for message in batch if message.id in errors)
+        return failed
+
+    def _release_expiring(self):
+        """Release buffered messages about to become visible again."""
+        deadline = time() + self.release_margin
+        expiring = [m for expires, m in self.buffer if expires <= deadline]
+        if not expiring:
+            return
+        self.buffer = deque(
+            (expires, m) for expires, m in self.buffer if expires > deadline)
+        self._change_visibility(expiring, 0)
+
+    def _receive(self, wait_time_seconds):
+        """Fill the prefetch buffer, only the first request waits."""
+        expires = time() + self._visibility_timeout()
+        while len(self.buffer) < self.prefetch:
+            count = min(self.MAX_MESSAGES, self.prefetch - len(self.buffer))
+            messages = self.handle.get_messages(
+                num_messages=count, wait_time_seconds=wait_time_seconds)
+            for message in messages:
+                self.buffer.append((expires, message))
+            if len(messages) < count:
+                break
+            wait_time_seconds = 0
+
+    def _read(self, wait_time_seconds):
+        if not self.prefetch:
+            return self.handle.read(wait_time_seconds=wait_time_seconds)
+        self._release_expiring()
+        if not self.buffer:
+            self._receive(wait_time_seconds)
+        if not self.buffer:
+            return None
+        return self.buffer.popleft()[1]
+
+    def _send_batch(self, items):
+        """Send one batch of (body, delay), retrying only the failed ones.
+
+        Returns list of (item, error) which were not sent.
+        """
+        entries = [(str(i), item) for i, item in enumerate(items)]
+        rejected = []
+        exc = None
+        for _repeat in range(6):
+            try:
+                response = self.handle.write_batch(
+                    [(i, body, delay) for i, (body, delay) in entries])
+            except IOError as e:
+                sleep(_repeat * 2 + 1)
+                exc = e
+                continue
+            errors = dict((error['id'], error) for error in response.errors)
+            # Invalid messages would fail again
+            rejected.extend(
+                (item, errors[i]) for i, item in entries
+                if i in errors and _sender_fault(errors[i]))
+            entries = [
+                (i, item) for i, item in entries
+                if i in errors and not _sender_fault(errors[i])]
+            if not entries:
+                break
+            exc = Exception('Messages not sent: {}'.format(
+                [errors[i] for i, _item in entries]))
+            sleep(_repeat * 2 + 1)
+        return rejected + [(item, exc) for _i, item in entries]
+
+    def _take_batch(self):
+        """Remove one batch of collected items (under _put_lock)."""
+        size = 0
+        count = 0
+        for body, _delay in self.outgoing:
+            if (count == self.MAX_MESSAGES or
+                    size + len(body) > self.MAX_BATCH_SIZE):
+                break
+            size += len(body)
+            count += 1
+        batch = self.outgoing[:count]
+        del self.outgoing[:count]
+        self.outgoing_size -= size
+        return batch
+
+    def _batch_ready(self):
+        return (len(self.outgoing) >= self.MAX_MESSAGES or
+                self.outgoing_size >= self.MAX_BATCH_SIZE)
+
+    def _send_outgoing(self):
+        """Send all collected items, keep the failed ones in unsent."""
+        with self._send_lock:
+            while True:
+                with self._put_lock:
+                    batch = self._take_batch()
+                if not batch:
+                    break
+                try:
+                    failed = self._send_batch(batch)
+                except Exception as ex:
+                    failed = [(item, ex) for item in batch]
+                if failed:
+                    with self._put_lock:
+                        self.unsent.extend(failed)
+
+    def flush(self):
+        """Send all collected items.
+
+        Raise if any item was not sent, also by the background thread.
+        The exception has list of ((body, delay), error) in unsent.
+        """
+        self._send_outgoing()
+        with self._put_lock:
+            unsent, self.unsent = self.unsent, []
+        if unsent:
+            ex = Exception('{} messages not sent: {}'.format(
+                len(unsent), unsent[0][1]))
+            ex.unsent = unsent
+            raise ex
+
+    def _delete_batch(self, messages):
+        """Delete one batch of messages.
+
+        Only the failed messages are sent again (as a smaller batch).
+        Returns list of (message, error) which were not deleted.
+        """
+        rejected = []
+        exc = None
+        for _repeat in range(6):
+            try:
+                response = self.handle.delete_message_batch(messages)
+            except IOError as e:
+                sleep(_repeat * 2 + 1)
+                exc = e
+                continue
+            errors = dict((error['id'], error) for error in response.errors)
+            # Invalid receipt handles would fail again
+            rejected.extend(
+                (m, errors[m.id]) for m in messages
+                if m.id in errors and _sender_fault(errors[m.id]))
+            messages = [
+                m for m in messages
+                if m.id in errors and not _sender_fault(errors[m.id])]
+            if not messages:
+                break
+            exc = Exception('Messages not deleted: {}'.format(
+                [errors[m.id] for m in messages]))
+            sleep(_repeat * 2 + 1)
+        return rejected + [(m, exc) for m in messages]
+
+    def _delete_acks(self):
+        """Delete all collected messages, keep the failed ones in unacked."""
+        with self._ack_send_lock:
+            while True:
+                with self._ack_lock:
+                    batch = self.acks[:self.MAX_MESSAGES]
+                    del self.acks[:self.MAX_MESSAGES]
+                if not batch:
+                    break
+                try:
+                    failed = self._delete_batch(batch)
+                except Exception as ex:
+                    failed = [(m, ex) for m in batch]
+                if failed:
+                    with self._ack_lock:
+                        self.unacked.extend(failed)
+
+    def flush_acks(self):
+        """Delete all collected messages.
+
+        Raise if any message was not deleted, also by the background
+        thread. The exception has list of (message, error) in unacked.
+        """
+        self._delete_acks()
+        with self._ack_lock:
+            unacked, self.unacked = self.unacked, []
+        if unacked:
+            ex = Exception('{} messages not deleted: {}'.format(
+                len(unacked), unacked[0][1]))
+            ex.unacked = unacked
+            raise ex
+
+    def _extend_in_flight(self):
+        now = time()
+        extend = {}  # timeout -> messages
+        with self._heartbeat_lock:
+            for key, (gotten, message) in list(self.in_flight.items()):
+                timeout = int(min(self.heartbeat,
+                                  gotten + self.max_lease - now))
+                if timeout < 1:
+                    # Held too long, let it become visible again
+                    del self.in_flight[key]
+                    continue
+                extend.setdefault(timeout, []).append(message)
+        for timeout, messages in extend.items():
+            self._change_visibility(messages, timeout)
+
+    def close(self):
+        """Release prefetched messages, send collected items and acks."""
+        for thread in (self._put_thread, self._ack_thread,
+                       self._heartbeat_thread):
+            if thread is not None:
+                thread.stop()
+        self._put_thread = None
+        self._ack_thread = None
+        self._heartbeat_thread = None
+        # Every step runs, the first error is raised at the end
+        errors = []
+        for step in (self.flush, self.flush_acks, self._release_buffer):
+            try:
+                step()
+            except Exception as ex:
+                errors.append(ex)
+        if errors:
+            raise errors[0]
+
+    def _release_buffer(self):
+        messages = [m for _, m in self.buffer]
+        self.buffer.clear()
+        if messages:
+            self._change_visibility(messages, 0)
 
     def qsize(self):
         return self.handle.count()
@@ -66,27 +405,73 @@ class Queue(BaseQueue):
         """
         if not (block and timeout is None):
             raise Exception('block and timeout must have default values')
-        self.handle.write(self.handle.new_message(item), delay_seconds=delay)
+        message = self.handle.new_message(item)
+        if self._put_thread is None:
+            self.handle.write(message, delay_seconds=delay)
+            return
+        body = message.get_body_encoded()
+        if len(body) > self.MAX_BATCH_SIZE:
+            raise Exception('Message is larger than {} bytes.'.format(
+                self.MAX_BATCH_SIZE))
+        with self._put_lock:
+            self.outgoing.append((body, int(delay or 0)))
+            self.outgoing_size += len(body)
+            full = self._batch_ready()
+        if full:
+            self.flush()
 
-    def get(self, block=True, timeout=None):
+    def get(self, block=True, timeout=None, handle=False):
         """Get item from the queue.
 
         Note that SQS can block either indefinitely,
         or between 1 and 20 seconds.
+        With handle, return Message handle of the item instead, which is
+        acknowledged by its own ack(), extend() or nack().
         """
+        self.message = None
         if block and timeout is None:
-            self.message = self.handle.read(wait_time_seconds=20)
-            while self.message is None:
-                self.message = self.handle.read(wait_time_seconds=20)
+            message = self._read(20)
+            while message is None:
+                message = self._read(20)
         elif block and 1 <= timeout <= 20:
-            self.message = self.handle.read(wait_time_seconds=timeout)
+            message = self._read(timeout)
         elif not block and timeout is None:
-            self.message = self.handle.read(wait_time_seconds=0)
+            message = self._read(0)
         else:
             raise Exception('invalid arguments')
-        if self.message is None:
+        if message is None:
             raise Empty
-        return self.message.get_body()
+        if self._heartbeat_thread is not None:
+            with self._heartbeat_lock:
+                self.in_flight[message.id] = [time(), message]
+        if handle:
+            return Message(self, message)
+        self.message = message
+        return message.get_body()
+
+    def _untrack(self, message):
+        with self._heartbeat_lock:
+            self.in_flight.pop(message.id, None)
+
+    def _delete(self, message):
+        self._untrack(message)
+        if self._ack_thread is None:
+            self.handle.delete_message(message)
+            return
+        with self._ack_lock:
+            self.acks.append(message)
+            full = len(self.acks) >= self.MAX_MESSAGES
+        if full:
+            self.flush_acks()
+
+    def _set_visibility(self, message, timeout):
+        for _repeat in range(6):
+            try:
+                self.handle.connection.change_message_visibility(
+                    self.handle, message.receipt_handle, timeout)
+                break
+            except IOError:
+                sleep(_repeat * 2 + 1)
 
     def task_done(self):
         """Acknowledge that a formerly enqueued task is complete.
@@ -96,8 +481,14 @@ class Queue(BaseQueue):
         """
         if self.message is None:
             raise Exception('no message to acknowledge')
-        self.handle.delete_message(self.message)
-        self.message = None
+        message, self.message = self.message, None
+        self._delete(message)
+
+    def update(self, lease_time=600):
+        """Update visibility timeout for a formerly enqueued message."""
+        if self.message is None:
+            raise Exception('no message to update')
+        self._set_visibility(self.message, lease_time)
 
     def has_available(self):
         """It is any message available for lease.